@@ -0,0 +1,284 @@
+import argparse, sys, os
+import collections
+import contextlib
+import json
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import pysam
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import covbamic
+
+
+def lineage_alleles(variant, variant_file):
+    # allele of variant at every site in the variant table, "-" for deletions
+    alleles = {}
+    with open(variant_file) as f:
+        header = f.readline().rstrip().split("\t")
+        pos_col, var_col = header.index("Nucleotide position"), header.index(variant)
+        for line in f:
+            splitline = line.rstrip().split("\t")
+            alleles[int(splitline[pos_col]) - 1] = splitline[var_col].upper()
+    return alleles
+
+
+def amplicons(length, amplicon_length, amplicon_overlap):
+    step = amplicon_length - amplicon_overlap
+    starts = list(range(0, max(length - amplicon_length, 0) + 1, step))
+    if starts[-1] + amplicon_length < length:
+        starts.append(length - amplicon_length)
+    return [(start, start + amplicon_length) for start in starts]
+
+
+def make_template(refseq, alleles, start, stop):
+    # read sequence and cigar for a lineage between start and stop, deletions are taken from the lineage alleles
+    seq = []
+    cigar = []
+    for pos in range(start, stop):
+        base = alleles.get(pos, refseq[pos])
+        if base == "-":
+            op = 2
+        else:
+            op = 0
+            seq.append(base)
+        if cigar and cigar[-1][0] == op:
+            cigar[-1][1] += 1
+        else:
+            cigar.append([op, 1])
+    # reads can't start or end with a deletion
+    while cigar and cigar[0][0] == 2:
+        start += cigar.pop(0)[1]
+    while cigar and cigar[-1][0] == 2:
+        cigar.pop()
+    return start, "".join(seq), [tuple(i) for i in cigar]
+
+
+def make_read(name, template, reverse, first, mate_start, tlen, error_rate, rng):
+    start, seq, cigar = template
+    if error_rate:
+        num_errors = rng.binomial(len(seq), error_rate)
+        if num_errors:
+            seq = list(seq)
+            for pos in rng.integers(0, len(seq), num_errors):
+                seq[pos] = "ACGT"[("ACGT".find(seq[pos]) + 1 + int(rng.integers(0, 3))) % 4]
+            seq = "".join(seq)
+    read = pysam.AlignedSegment()
+    read.query_name = name
+    read.query_sequence = seq
+    read.flag = 1 | 2 | (64 if first else 128) | (16 if reverse else 32)
+    read.reference_id = 0
+    read.reference_start = start
+    read.mapping_quality = 60
+    read.cigartuples = cigar
+    read.query_qualities = pysam.qualitystring_to_array("F" * len(seq))
+    read.next_reference_id = 0
+    read.next_reference_start = mate_start
+    read.template_length = -tlen if reverse else tlen
+    return read
+
+
+def make_bam(bam_file, ref, variant_file, variantA, variantB, depth, read_length=250, amplicon_length=400,
+             amplicon_overlap=70, fraction_a=0.5, error_rate=0.001, seed=1):
+    # amplicon sequencing of a mixture of two lineages, each amplicon gets depth read pairs
+    rng = np.random.default_rng(seed)
+    with pysam.FastaFile(ref) as fasta:
+        contig = fasta.references[0]
+        refseq = fasta.fetch(contig).upper()
+    haplotypes = [lineage_alleles(variantA, variant_file), lineage_alleles(variantB, variant_file)]
+    header = {"HD": {"VN": "1.6", "SO": "unsorted"}, "SQ": [{"SN": contig, "LN": len(refseq)}]}
+    unsorted_file = bam_file + ".unsorted.bam"
+    with pysam.AlignmentFile(unsorted_file, "wb", header=header) as out:
+        for num, (start, stop) in enumerate(amplicons(len(refseq), amplicon_length, amplicon_overlap)):
+            length = min(read_length, stop - start)
+            templates = [(make_template(refseq, alleles, start, start + length), make_template(refseq, alleles, stop - length, stop))
+                         for alleles in haplotypes]
+            for pair, lineage in enumerate((rng.random(depth) >= fraction_a).tolist()):
+                forward, reverse = templates[lineage]
+                name = "amp%d_%d" % (num, pair)
+                out.write(make_read(name, forward, False, True, reverse[0], stop - start, error_rate, rng))
+                out.write(make_read(name, reverse, True, False, forward[0], stop - start, error_rate, rng))
+    pysam.sort("-o", bam_file, unsorted_file)
+    os.remove(unsorted_file)
+    pysam.index(bam_file)
+    return bam_file
+
+
+def timeit(func, repeats):
+    times = []
+    for i in range(repeats):
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def bench_sample(bam_file, workdir, variantA, variantB, repeats, threads, sample_depth=None):
+    dirname = os.path.dirname(os.path.abspath(covbamic.__file__))
+    variant_file = os.path.join(dirname, 'data', "variants.tsv")
+    reference = covbamic.open_reference(os.path.join(dirname, 'data', "nCoV-2019.reference.fasta"))
+    output_file = os.path.join(workdir, "bench.svg")
+    sites = [i + [covbamic.DEFAULT_CONTIG] for i in covbamic.get_sites(variantA, variantB, variant_file, False)]
+    positions = [i[1] for i in sites]
+    results = {}
+    with pysam.AlignmentFile(bam_file, "rb") as alignment:
+        results["get_sites"] = timeit(lambda: covbamic.get_sites(variantA, variantB, variant_file, False), repeats)
+        results["get_depth"] = timeit(lambda: [covbamic.get_depth(pos - 1, alignment) for pos in positions], repeats)
+        results["count_alleles"] = timeit(lambda: covbamic.count_alleles(alignment, [pos - 1 for pos in positions]), repeats)
+        results["get_minor"] = timeit(lambda: covbamic.get_minor(sites, alignment, reference, 0.2, 20, threads), repeats)
+        if sample_depth is not None:
+            results["get_minor_sampled"] = timeit(lambda: covbamic.get_minor(sites, alignment, reference, 0.2, 20, threads,
+                                                                             sample_depth=sample_depth), repeats)
+        counts = covbamic.count_alleles(alignment, [pos - 1 for pos in positions])
+    proportion = covbamic.variant_proportions(counts, sites)
+    ref_bases = [reference.fetch(i[4], i[1] - 1, i[1]).upper() for i in sites]
+    results["draw_output"] = timeit(lambda: covbamic.draw_output(positions, proportion, counts, [i[0] for i in sites], output_file,
+                                                                 variantA, variantB, ref_bases, True), repeats)
+    results["pipeline"] = timeit(lambda: covbamic.__main__(bam_file, variantA, variantB, output_file, True, True, 0.2, 20, True,
+                                                           threads), repeats)
+    command = [sys.executable, covbamic.__file__, "-b", bam_file, "-o", output_file, "-1", variantA, "-2", variantB, "-a", "-m",
+               "-p3", "-t", str(threads)]
+    results["command_line"] = timeit(lambda: subprocess.run(command, check=True, stdout=subprocess.DEVNULL), repeats)
+    return results
+
+
+def add_orphans(read, num):
+    # every 20th pair loses its proper pair flag and every 20th (another) has its mate unmapped, the pileup leaves out both
+    if num % 20 == 0:
+        read.flag &= ~2
+    elif num % 20 == 10:
+        read.flag = (read.flag & ~2) | 8
+    return read
+
+
+def check_stream(bam_file):
+    # counts of --stream against the pileup, from a sorted copy of the bam file with orphans added and from a name grouped
+    # copy of that with the rightmost mate first for every other pair. Returns the number of columns whose depth differs
+    # (should be 0) and the number whose alleles differ for each input (overlapping mates disagreeing at equal quality are
+    # resolved differently by htslib)
+    sorted_file = bam_file + ".orphans.bam"
+    grouped_file = bam_file + ".name_grouped.bam"
+    with pysam.AlignmentFile(bam_file, "rb") as alignment:
+        contig = alignment.references[0]
+        pairs = collections.defaultdict(list)
+        for read in alignment.fetch(contig):
+            pairs[read.query_name].append(read)
+        names = {name: num for num, name in enumerate(sorted(pairs))}
+        with pysam.AlignmentFile(sorted_file, "wb", template=alignment) as out:
+            for read in alignment.fetch(contig):
+                out.write(add_orphans(read, names[read.query_name]))
+        with pysam.AlignmentFile(grouped_file, "wb", template=alignment) as out:
+            for name, num in names.items():
+                for read in (pairs[name][::-1] if num % 2 else pairs[name]):
+                    out.write(add_orphans(read, num))
+    pysam.index(sorted_file)
+    with pysam.AlignmentFile(sorted_file, "rb") as alignment:
+        counts, covered = covbamic.count_genome(alignment, contig)[:2]
+    results = {}
+    for name, filename in (("sorted", sorted_file), ("name_grouped", grouped_file)):
+        with pysam.AlignmentFile(filename, "rb") as alignment:
+            stream_counts, stream_covered = covbamic.count_stream(alignment, [contig])[contig][:2]
+        results[name] = (int(((stream_counts.sum(axis=1) != counts.sum(axis=1)) | (stream_covered != covered)).sum()),
+                         int((stream_counts != counts).any(axis=1).sum()))
+    for filename in (sorted_file, sorted_file + ".bai", grouped_file):
+        os.remove(filename)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous_file, threshold, min_seconds=0.01):
+    # stages that got slower than threshold (as a fraction) compared with a previous run,
+    # stages faster than min_seconds are too noisy to compare
+    with open(previous_file) as f:
+        previous = json.load(f)
+    old = {(i["depth"], i["stage"]): i["median"] for i in previous["results"]}
+    regressions = []
+    for i in results:
+        key = (i["depth"], i["stage"])
+        if key not in old or max(old[key], i["median"]) < min_seconds:
+            continue
+        ratio = i["median"] / old[key]
+        sys.stdout.write("%d\t%s\t%.4f\t%.4f\t%.2fx\n" % (i["depth"], i["stage"], old[key], i["median"], ratio))
+        if ratio > 1 + threshold:
+            regressions.append(i)
+    return regressions
+
+
+def main(args):
+    dirname = os.path.dirname(os.path.abspath(covbamic.__file__))
+    variant_file = os.path.join(dirname, 'data', "variants.tsv")
+    ref = os.path.join(dirname, 'data', "nCoV-2019.reference.fasta")
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp(prefix="covbamic_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    results = []
+    stream_errors = []
+    for depth in args.depths:
+        bam_file = os.path.join(workdir, "synthetic_%s_%s_%dx_%d_%d_%d_%g_%g_%d.bam" % (
+            args.variant_1, args.variant_2, depth, args.read_length, args.amplicon_length, args.amplicon_overlap,
+            args.fraction, args.error_rate, args.seed))
+        if not os.path.exists(bam_file + ".bai"):
+            start = time.perf_counter()
+            make_bam(bam_file, ref, variant_file, args.variant_1, args.variant_2, depth, args.read_length,
+                     args.amplicon_length, args.amplicon_overlap, args.fraction, args.error_rate, args.seed)
+            sys.stderr.write("made %s in %.1fs\n" % (bam_file, time.perf_counter() - start))
+        for stage, times in bench_sample(bam_file, workdir, args.variant_1, args.variant_2, args.repeats, args.threads,
+                                         args.sample_depth).items():
+            results.append({"depth": depth, "stage": stage, "seconds": times, "median": statistics.median(times),
+                            "min": min(times)})
+            sys.stderr.write("%dx\t%s\t%.4fs\n" % (depth, stage, statistics.median(times)))
+        if args.check_stream:
+            for name, (depth_diff, allele_diff) in check_stream(bam_file).items():
+                sys.stderr.write("%dx\tstream %s\t%d columns with a different depth, %d with different alleles\n" % (
+                    depth, name, depth_diff, allele_diff))
+                if depth_diff:
+                    stream_errors.append((depth, name))
+    output = {"meta": {"commit": git_commit(), "python": platform.python_version(), "pysam": pysam.__version__,
+                       "numpy": np.__version__, "platform": platform.platform(), "cpus": os.cpu_count(),
+                       "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+              "config": vars(args), "results": results}
+    with open(args.output, "w") as out:
+        json.dump(output, out, indent=1)
+    if args.compare is not None:
+        regressions = compare(results, args.compare, args.threshold)
+        for i in regressions:
+            sys.stderr.write("regression: %s at %dx\n" % (i["stage"], i["depth"]))
+        if regressions:
+            sys.exit(1)
+    for depth, name in stream_errors:
+        sys.stderr.write("stream depth differs from the pileup: %s at %dx\n" % (name, depth))
+    if stream_errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time covbamic stages on synthetic amplicon bam files.")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="json file to write timings to")
+    parser.add_argument("-D", "--depths", type=int, nargs="+", default=[100, 1000], help="read pairs per amplicon of each synthetic bam file")
+    parser.add_argument("-1", "--variant_1", default="BA.4", help="first lineage in the synthetic mixture")
+    parser.add_argument("-2", "--variant_2", default="BA.5", help="second lineage in the synthetic mixture")
+    parser.add_argument("-F", "--fraction", type=float, default=0.5, help="fraction of reads from the first lineage")
+    parser.add_argument("-l", "--read_length", type=int, default=250, help="read length")
+    parser.add_argument("-L", "--amplicon_length", type=int, default=400, help="amplicon length")
+    parser.add_argument("-v", "--amplicon_overlap", type=int, default=70, help="overlap between neighbouring amplicons")
+    parser.add_argument("-e", "--error_rate", type=float, default=0.001, help="per base sequencing error rate")
+    parser.add_argument("-r", "--repeats", type=int, default=3, help="times each stage is run")
+    parser.add_argument("-t", "--threads", type=int, default=1, help="threads passed to get_minor and the pipeline")
+    parser.add_argument("-S", "--sample_depth", type=int, default=1000, help="also time get_minor with this --sample_depth")
+    parser.add_argument("-s", "--seed", type=int, default=1, help="random seed for the synthetic bam files")
+    parser.add_argument("-k", "--check_stream", action="store_true", help="check the --stream depth against the pileup on the "
+                                                                             "sorted bam files and name grouped copies")
+    parser.add_argument("-w", "--workdir", help="directory for synthetic bam files, reused between runs (default: new temporary directory)")
+    parser.add_argument("-c", "--compare", help="previous benchmark json, report stages that got slower")
+    parser.add_argument("-T", "--threshold", type=float, default=0.2, help="fractional slowdown reported as a regression (with -c)")
+    main(parser.parse_args())
@@ -1,46 +1,224 @@
 import argparse, sys, os
+import collections
+import contextlib
+import cProfile
+import functools
+import glob
+import hashlib
+import heapq
+import http.server
+import json
+import multiprocessing
+import re
+import resource
+import socketserver
+import stat
+import time
+import traceback
+import urllib.parse
+import zlib
+from xml.sax.saxutils import escape
 import pysam
+import numpy as np
 from collections import defaultdict
 
-def get_depth(pos, samfile):
+# contig of the bundled reference and variant table
+DEFAULT_CONTIG = "MN908947.3"
+
+# column order of the allele count matrices returned by count_alleles
+BASES = "ACGTN-"
+_BASE_INDEX = np.full(256, 4, dtype=np.intp)
+for _num, _base in enumerate(BASES):
+    _BASE_INDEX[ord(_base)] = _num
+    _BASE_INDEX[ord(_base.lower())] = _num
+_BASE_INDEX[ord("*")] = 5
+_BASE_INDEX[ord(">")] = 6
+_BASE_INDEX[ord("<")] = 6
+
+
+def count_column(pileupcolumn):
+    # first character of each query sequence is the base ("*" for deletions, "<"/">" for reference skips)
+    seqs = pileupcolumn.get_query_sequences(add_indels=True)
+    codes = np.frombuffer("".join([i[:1] for i in seqs]).encode("ascii", "replace"), dtype=np.uint8)
+    return np.bincount(_BASE_INDEX[codes], minlength=7)[:6]
+
+
+def pileup_args(min_base_quality=13, min_mapping_quality=0, max_depth=8000):
+    # settings of every pileup, also applied to the counts made from reads (stream, sampling, linkage) along with the pileup's
+    # read filter (pileup_skips, orphans are left out as pysam's ignore_orphans does by default). The defaults are pysam's,
+    # a max_depth of 0 lifts the limit (pysam takes 0 as its default of 8000). min_base_quality must be at least 1: where
+    # overlapping mates meet the pileup (and count_batch) leaves one mate out by giving its base quality 0
+    if min_base_quality < 1:
+        raise ValueError("min_base_quality must be at least 1, not %d" % min_base_quality)
+    return {"min_base_quality": min_base_quality, "min_mapping_quality": min_mapping_quality,
+            "max_depth": max_depth if max_depth > 0 else 2**31 - 1}
+
+
+DEFAULT_PILEUP = pileup_args()
+
+
+def site_regions(positions, max_gap=1000):
+    # group sorted 0-based positions into regions so that distant sites don't share a pileup
+    regions = []
+    for pos in sorted(set(positions)):
+        if regions and pos - regions[-1][1] <= max_gap:
+            regions[-1][1] = pos
+        else:
+            regions.append([pos, pos])
+    return regions
+
+
+def count_alleles(samfile, positions, contig=DEFAULT_CONTIG, stats=None, pileup=None, saturated=None):
+    # contig is either one contig for all positions or a list with the contig of each position.
+    # pileup is from pileup_args, saturated can be a boolean array for the positions, set where the pileup lost reads to max_depth.
+    # Sites always go through the pileup, for a few columns it counts every read faster than a sample can be drawn in python
+    if pileup is None:
+        pileup = DEFAULT_PILEUP
+    if isinstance(contig, str):
+        contig = [contig] * len(positions)
+    counts = np.zeros((len(positions), len(BASES)), dtype=np.int64)
+    rows = defaultdict(list)
+    for num, (site_contig, pos) in enumerate(zip(contig, positions)):
+        rows[(site_contig, pos)].append(num)
+    visited, used, num_saturated = 0, 0, 0
+    for site_contig in dict.fromkeys(contig):
+        site_positions = [pos for i, pos in rows if i == site_contig]
+        for start, stop in site_regions(site_positions):
+            depth, deepest = {}, 0
+            for pileupcolumn in samfile.pileup(site_contig, start, stop + 1, truncate=True, **pileup):
+                visited += 1
+                deepest = max(deepest, pileupcolumn.nsegments)
+                key = (site_contig, pileupcolumn.reference_pos)
+                if key not in rows:
+                    continue
+                column = count_column(pileupcolumn)
+                counts[rows[key]] = column
+                depth[key] = pileupcolumn.nsegments
+                used += 1
+                if stats is not None:
+                    stats.add("site_reads_inspected", column.sum())
+            if can_truncate(deepest, pileup):
+                full_depth = span_depth(samfile, site_contig, start, stop + 1, pileup["min_mapping_quality"])
+                for key, nsegments in depth.items():
+                    if nsegments < full_depth[key[1] - start]:
+                        num_saturated += 1
+                        if saturated is not None:
+                            saturated[rows[key]] = True
+    if stats is not None:
+        stats.add("site_columns_visited", visited)
+        stats.add("site_columns_used", used)
+        stats.add("site_columns_saturated", num_saturated)
+    return counts
+
+
+def get_depth(pos, samfile, contig=DEFAULT_CONTIG, pileup=None):
     basefreq = defaultdict(lambda: 0)
-    for pileupcolumn in samfile.pileup("MN908947.3", pos):
-        if pileupcolumn.pos != pos:
-            continue
-        depth = 0
-        for pileupread in pileupcolumn.pileups:
-            if pileupread.is_del:
-                basefreq["-"] += 1
-                depth += 1
-            elif pileupread.is_refskip:
-                pass
-            else:
-                base = pileupread.alignment.query_sequence[pileupread.query_position]
-                base = base.upper()
-                basefreq[base] += 1
-                depth += 1
+    for num, count in enumerate(count_alleles(samfile, [pos], contig, pileup=pileup)[0]):
+        if count:
+            basefreq[BASES[num]] = int(count)
     return(basefreq)
 
 
+def variant_proportions(counts, sites):
+    # split counts at each site into [varA, varB, both, other] using the alleles of the two variants
+    rows = np.arange(len(sites))
+    base_index = {base: num for num, base in enumerate(BASES)}
+    idx_a = np.array([base_index.get(i[2], len(BASES)) for i in sites], dtype=np.intp)
+    idx_b = np.array([base_index.get(i[3], len(BASES)) for i in sites], dtype=np.intp)
+    padded = np.hstack([counts, np.zeros((len(sites), 1), dtype=counts.dtype)])
+    count_a = padded[rows, idx_a]
+    count_b = padded[rows, idx_b]
+    same = idx_a == idx_b
+    both = np.where(same, count_a, 0)
+    count_a = np.where(same, 0, count_a)
+    count_b = np.where(same, 0, count_b)
+    total = counts.sum(axis=1)
+    other = total - count_a - count_b - both
+    with np.errstate(divide="ignore", invalid="ignore"):
+        proportion = np.stack([count_a, count_b, both, other], axis=1) / total[:, None]
+    return np.nan_to_num(proportion)
+
+
+def nnls(A, b, max_iter=None):
+    # Lawson and Hanson's active set method for min ||Ax - b|| with x >= 0
+    m, n = A.shape
+    if max_iter is None:
+        max_iter = 3 * n
+    tol = 10 * np.finfo(float).eps * np.abs(A).sum(axis=0).max(initial=0) * max(m, n)
+    x = np.zeros(n)
+    passive = np.zeros(n, dtype=bool)
+    w = A.T @ b
+    for i in range(max_iter):
+        if passive.all() or w[~passive].max() <= tol:
+            break
+        passive[np.argmax(np.where(passive, -np.inf, w))] = True
+        while True:
+            z = np.zeros(n)
+            z[passive] = np.linalg.lstsq(A[:, passive], b, rcond=None)[0]
+            if z[passive].min() > tol:
+                break
+            # step back to where a passive variable hits zero and release it
+            negative = passive & (z <= tol)
+            alpha = np.min(x[negative] / (x[negative] - z[negative]))
+            x = x + alpha * (z - x)
+            passive &= x > tol
+            x[~passive] = 0
+        x = z
+        w = A.T @ (b - A @ x)
+    return x
+
+
+def allele_codes(alleles, num_lineages):
+    # column in BASES of each lineage's allele at each site (sites x lineages)
+    codes = np.array([ord(j[:1] or "N") for i in alleles for j in i], dtype=np.intp)
+    return _BASE_INDEX[codes].reshape(len(alleles), num_lineages)
+
+
+def lineage_frequencies(counts, codes):
+    # fraction of the reads at each site that carry each lineage's allele, codes is from allele_codes
+    padded = np.hstack([counts, np.zeros((len(counts), 1), dtype=counts.dtype)])
+    depth = counts.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.nan_to_num(np.take_along_axis(padded, codes, axis=1) / depth[:, None])
+
+
+def estimate_mixture(counts, codes):
+    # lineage proportions that best explain the allele frequencies, by non-negative least squares over one row for each
+    # distinct lineage allele at each site (a row is 1 for the lineages with that allele), rows weighted by sqrt(depth).
+    # Returns the proportions scaled to sum to 1 and the fraction of the reads that they explain
+    depth = counts.sum(axis=1)
+    num_lineages = codes.shape[1]
+    if not num_lineages or not len(codes):
+        return np.zeros(num_lineages), 0.0
+    site = np.repeat(np.arange(len(codes)), num_lineages)
+    row_key, row = np.unique(site * (len(BASES) + 1) + codes.ravel(), return_inverse=True)
+    A = np.zeros((len(row_key), num_lineages))
+    A[row, np.tile(np.arange(num_lineages), len(codes))] = 1
+    row_site, row_code = row_key // (len(BASES) + 1), row_key % (len(BASES) + 1)
+    padded = np.hstack([counts, np.zeros((len(counts), 1), dtype=counts.dtype)])
+    keep = depth[row_site] > 0
+    weight = np.sqrt(depth[row_site][keep])
+    b = padded[row_site, row_code][keep] / depth[row_site][keep]
+    x = nnls(A[keep] * weight[:, None], b * weight)
+    total = x.sum()
+    if total == 0:
+        return x, 0.0
+    return x / total, float(min(total, 1.0))
+
 
 def get_sites(variantA, variantB, variant_file, diff_only=True):
+    # variant_file is either a variant table or a database made from one by compile_variants
+    if os.path.isdir(variant_file):
+        return open_variant_db(variant_file).get_sites(variantA, variantB, diff_only)
     poslist = []
     with open(variant_file) as f:
         header = f.readline().rstrip().split("\t")
-        aa_col, pos_col, a_col, b_col, a_col_pres, b_col_pres = None, None, None, None, None, None
-        for num, i in enumerate(header):
-            if i == "Nucleotide position":
-                pos_col = num
-            elif i == "aa_SNP":
-                aa_col = num
-            elif i == variantA:
-                a_col = num
-            elif i == variantB:
-                b_col = num
-            elif i == variantA + "_present":
-                a_col_pres = num
-            elif i == variantB + "_present":
-                b_col_pres = num
+        for lineage in (variantA, variantB):
+            if lineage not in header or lineage + "_present" not in header:
+                raise ValueError("lineage %s is not in %s" % (lineage, variant_file))
+        aa_col, pos_col = header.index("aa_SNP"), header.index("Nucleotide position")
+        a_col, b_col = header.index(variantA), header.index(variantB)
+        a_col_pres, b_col_pres = header.index(variantA + "_present"), header.index(variantB + "_present")
         for line in f:
             splitline = line.rstrip().split("\t")
             a_pres, b_pres, pos, a, b, aa = splitline[a_col_pres], splitline[b_col_pres], splitline[pos_col], \
@@ -53,20 +231,166 @@ def get_sites(variantA, variantB, variant_file, diff_only=True):
                     poslist.append([aa, pos, a, b])
     return(poslist)
 
+
+def get_lineage_sites(lineages, variant_file, diff_only=True):
+    # sites that define any of the lineages, with diff_only only those where the lineages don't all share an allele.
+    # Returns the sites (the alleles of the first and last lineage in place of variant 1 and 2) and the alleles of every
+    # lineage at each site
+    if os.path.isdir(variant_file):
+        return open_variant_db(variant_file).get_lineage_sites(lineages, diff_only)
+    sites, alleles = [], []
+    with open(variant_file) as f:
+        header = f.readline().rstrip().split("\t")
+        for lineage in lineages:
+            if lineage not in header or lineage + "_present" not in header:
+                raise ValueError("lineage %s is not in %s" % (lineage, variant_file))
+        aa_col, pos_col = header.index("aa_SNP"), header.index("Nucleotide position")
+        cols = [header.index(i) for i in lineages]
+        pres_cols = [header.index(i + "_present") for i in lineages]
+        for line in f:
+            splitline = line.rstrip().split("\t")
+            if "1" not in [splitline[i] for i in pres_cols]:
+                continue
+            site_alleles = [splitline[i].upper() for i in cols]
+            if not diff_only or len(set(site_alleles)) > 1:
+                sites.append([splitline[aa_col], int(splitline[pos_col]), site_alleles[0], site_alleles[-1]])
+                alleles.append(site_alleles)
+    return sites, alleles
+
+
+# bump when the layout of compiled variant databases changes
+VARIANT_DB_VERSION = 1
+
+
+def read_variant_table(variant_file):
+    # every column X with a matching X_present column is a lineage. Returns the lineages, positions and names of the
+    # sites, the alleles (lineage by site, as bytes) and whether each site is present in each lineage
+    with open(variant_file) as f:
+        header = f.readline().rstrip().split("\t")
+        pos_col = header.index("Nucleotide position")
+        aa_col = header.index("aa_SNP") if "aa_SNP" in header else None
+        lineages = [i for i in header if i + "_present" in header]
+        allele_cols = [header.index(i) for i in lineages]
+        present_cols = [header.index(i + "_present") for i in lineages]
+        positions, names, alleles, present = [], [], [], []
+        for line in f:
+            splitline = line.rstrip().split("\t")
+            if splitline == [""]:
+                continue
+            row = "".join([splitline[i] for i in allele_cols]).upper()
+            if len(row) != len(lineages):
+                raise ValueError("alleles at %s aren't all single bases" % splitline[pos_col])
+            positions.append(int(splitline[pos_col]))
+            names.append(splitline[aa_col] if aa_col is not None else splitline[pos_col])
+            alleles.append(np.frombuffer(row.encode("ascii"), dtype=np.uint8))
+            present.append(np.frombuffer("".join([splitline[i][:1] or "0" for i in present_cols]).encode("ascii"), dtype=np.uint8) == ord("1"))
+    alleles = np.ascontiguousarray(np.array(alleles, dtype=np.uint8).reshape(len(positions), len(lineages)).T)
+    present = np.array(present, dtype=bool).reshape(len(positions), len(lineages)).T
+    return lineages, np.array(positions, dtype=np.int32), np.array([i.encode() for i in names], dtype="S"), alleles, present
+
+
+def present_index(present):
+    # CSR index (indptr, indices) of the sites present in each lineage
+    indptr = np.zeros(len(present) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(present.sum(axis=1))
+    return indptr, np.nonzero(present)[1].astype(np.int32)
+
+
+def compile_variants(variant_file, db_dir):
+    # alleles are stored lineage by lineage so that a lineage's alleles are contiguous and the sites present in each
+    # lineage are indexed in CSR form
+    lineages, positions, names, alleles, present = read_variant_table(variant_file)
+    indptr, indices = present_index(present)
+    os.makedirs(db_dir, exist_ok=True)
+    np.save(os.path.join(db_dir, "positions.npy"), positions)
+    np.save(os.path.join(db_dir, "names.npy"), names)
+    np.save(os.path.join(db_dir, "alleles.npy"), alleles)
+    np.save(os.path.join(db_dir, "present_indptr.npy"), indptr)
+    np.save(os.path.join(db_dir, "present_indices.npy"), indices)
+    with open(os.path.join(db_dir, "meta.json"), "w") as out:
+        json.dump({"version": VARIANT_DB_VERSION, "source": os.path.abspath(variant_file), "sites": len(positions),
+                   "lineages": lineages}, out)
+    open_variant_db.cache_clear()
+    return len(lineages), len(positions)
+
+
+class VariantDB:
+    # memory mapped variant database written by compile_variants
+
+    def __init__(self, db_dir):
+        with open(os.path.join(db_dir, "meta.json")) as f:
+            meta = json.load(f)
+        if meta["version"] != VARIANT_DB_VERSION:
+            raise ValueError("%s was compiled by a different version, compile it again" % db_dir)
+        self.source = "the variant database"
+        self.lineages = {name: num for num, name in enumerate(meta["lineages"])}
+        self.positions = np.load(os.path.join(db_dir, "positions.npy"), mmap_mode="r")
+        self.names = np.load(os.path.join(db_dir, "names.npy"), mmap_mode="r")
+        self.alleles = np.load(os.path.join(db_dir, "alleles.npy"), mmap_mode="r")
+        self.indptr = np.load(os.path.join(db_dir, "present_indptr.npy"), mmap_mode="r")
+        self.indices = np.load(os.path.join(db_dir, "present_indices.npy"), mmap_mode="r")
+
+    def lineage(self, name):
+        if name not in self.lineages:
+            raise ValueError("lineage %s is not in %s" % (name, self.source))
+        return self.lineages[name]
+
+    def present(self, name):
+        # indices of the sites that define lineage name
+        num = self.lineage(name)
+        return self.indices[self.indptr[num]:self.indptr[num+1]]
+
+    def get_sites(self, variantA, variantB, diff_only=True):
+        a, b = self.lineage(variantA), self.lineage(variantB)
+        idx = np.union1d(self.present(variantA), self.present(variantB))
+        a_alleles, b_alleles = self.alleles[a][idx], self.alleles[b][idx]
+        if diff_only:
+            keep = a_alleles != b_alleles
+            idx, a_alleles, b_alleles = idx[keep], a_alleles[keep], b_alleles[keep]
+        return [[self.names[i].decode(), int(self.positions[i]), chr(j), chr(k)]
+                for i, j, k in zip(idx.tolist(), a_alleles.tolist(), b_alleles.tolist())]
+
+
+    def get_lineage_sites(self, lineages, diff_only=True):
+        nums = [self.lineage(i) for i in lineages]
+        idx = functools.reduce(np.union1d, [self.present(i) for i in lineages], np.zeros(0, dtype=np.int64))
+        alleles = self.alleles[nums][:, idx].T
+        if diff_only:
+            keep = (alleles != alleles[:, :1]).any(axis=1)
+            idx, alleles = idx[keep], alleles[keep]
+        alleles = [[chr(j) for j in i] for i in alleles.tolist()]
+        return [[self.names[i].decode(), int(self.positions[i]), j[0], j[-1]] for i, j in zip(idx.tolist(), alleles)], alleles
+
+
+class VariantTable(VariantDB):
+    # variant table parsed into memory, with the lookups of a compiled database
+
+    def __init__(self, variant_file):
+        lineages, self.positions, self.names, self.alleles, present = read_variant_table(variant_file)
+        self.source = variant_file
+        self.lineages = {name: num for num, name in enumerate(lineages)}
+        self.indptr, self.indices = present_index(present)
+
+
+@functools.lru_cache(maxsize=4)
+def open_variant_db(db_dir):
+    return VariantDB(db_dir)
+
 def colorstr(rgb): return "#%02x%02x%02x" % (rgb[0],rgb[1],rgb[2])
 
+def numstr(x): return ("%.2f" % x).rstrip("0").rstrip(".")
+
 class scalableVectorGraphics:
 
-    def __init__(self, height, width):
-        self.height = height
-        self.width = width
-        self.out = '''<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+    # elements are collected in a list and written once, shared styles become css classes
+    header = '''<?xml version="1.0" encoding="UTF-8" standalone="no"?>
     <svg
        xmlns:dc="http://purl.org/dc/elements/1.1/"
        xmlns:cc="http://creativecommons.org/ns#"
        xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
        xmlns:svg="http://www.w3.org/2000/svg"
        xmlns="http://www.w3.org/2000/svg"
+       xmlns:xlink="http://www.w3.org/1999/xlink"
        xmlns:sodipodi="http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd"
        xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape"
        height="%f"
@@ -88,7 +412,11 @@ class scalableVectorGraphics:
         </rdf:RDF>
       </metadata>
       <defs
-         id="defs120" />
+         id="defs120">
+        <style type="text/css"><![CDATA[
+.t{font-style:normal;font-weight:normal;line-height:125%%;letter-spacing:0px;word-spacing:0px;fill-opacity:1;stroke:none;font-family:sans-serif}
+%s]]></style>
+      </defs>
       <sodipodi:namedview
          pagecolor="#ffffff"
          bordercolor="#666666"
@@ -113,22 +441,54 @@ class scalableVectorGraphics:
          id="title4">Easyfig</title>
       <g
          style="fill-opacity:1.0; stroke:black; stroke-width:1;"
-         id="g6">''' % (self.height, self.width)
+         id="g6">
+'''
+
+    def __init__(self, height, width):
+        self.height = height
+        self.width = width
+        self.parts = []
+        self.classes = {}
+        self.defs = []
+
+    def style_class(self, style):
+        name = self.classes.get(style)
+        if name is None:
+            name = "s%d" % len(self.classes)
+            self.classes[style] = name
+        return name
+
+    def element_count(self):
+        return len(self.parts)
 
     def drawLine(self, x1, y1, x2, y2, th=1, cl=(0, 0, 0), alpha = 1.0):
-        self.out += '  <line x1="%f" y1="%f" x2="%f" y2="%f"\n        stroke-width="%f" stroke="%s" stroke-opacity="%f" stroke-linecap="round" />\n' % (x1, y1, x2, y2, th, colorstr(cl), alpha)
+        cls = self.style_class('stroke-width:%spx;stroke:%s;stroke-opacity:%s;stroke-linecap:round' % (numstr(th), colorstr(cl), numstr(alpha)))
+        self.parts.append('<line class="%s" x1="%s" y1="%s" x2="%s" y2="%s"/>\n' % (cls, numstr(x1), numstr(y1), numstr(x2), numstr(y2)))
 
     def drawPath(self, xcoords, ycoords, th=1, cl=(0, 0, 0), alpha=0.9):
-        self.out += '  <path d="M%f %f' % (xcoords[0], ycoords[0])
-        for i in range(1, len(xcoords)):
-            self.out += ' L%f %f' % (xcoords[i], ycoords[i])
-        self.out += '"\n        stroke-width="%f" stroke="%s" stroke-opacity="%f" stroke-linecap="butt" fill="none" z="-1" />\n' % (th, colorstr(cl), alpha)
+        cls = self.style_class('stroke-width:%spx;stroke:%s;stroke-opacity:%s;stroke-linecap:butt;fill:none' % (numstr(th), colorstr(cl), numstr(alpha)))
+        points = " L".join(["%s %s" % (numstr(x), numstr(y)) for x, y in zip(xcoords, ycoords)])
+        self.parts.append('<path class="%s" d="M%s"/>\n' % (cls, points))
 
 
     def writesvg(self, filename):
-        outfile = open(filename, 'w')
-        outfile.write(self.out + ' </g>\n</svg>')
-        outfile.close()
+        with open(filename, 'w') as outfile:
+            outfile.writelines(self.chunks())
+            return outfile.tell()
+
+    def chunks(self):
+        styles = "".join([".%s{%s}\n" % (name, style) for style, name in self.classes.items()])
+        yield self.header % (self.height, self.width, styles)
+        yield from self.defs
+        yield from self.parts
+        yield ' </g>\n</svg>'
+
+    def tostring(self):
+        return "".join(self.chunks())
+
+    def drawPolygon(self, points, fc, oc=(0,0,0), lt=1):
+        cls = self.style_class('fill:%s;stroke:%s;stroke-width:%spx' % (colorstr(fc), colorstr(oc), numstr(lt)))
+        self.parts.append('<polygon class="%s" points="%s"/>\n' % (cls, " ".join(["%s,%s" % (numstr(x), numstr(y)) for x, y in points])))
 
     def drawRightArrow(self, x, y, wid, ht, fc, oc=(0,0,0), lt=1):
         if lt > ht /2:
@@ -138,13 +498,9 @@ class scalableVectorGraphics:
         x2 = x + wid - ht / 2
         ht -= 1
         if wid > ht/2:
-            self.out += '  <polygon fill="%s" stroke="%s" stroke-width="%f"\n' % (colorstr(fc), colorstr(oc), lt)
-            self.out += '           points="%f,%f %f,%f %f,%f %f,%f %f,%f %f,%f %f,%f" />\n' % (x, y+ht/4, x2, y+ht/4,
-                                                                                                x2, y, x1, y1, x2, y+ht,
-                                                                                                x2, y+3*ht/4, x, y+3*ht/4)
+            self.drawPolygon([(x, y+ht/4), (x2, y+ht/4), (x2, y), (x1, y1), (x2, y+ht), (x2, y+3*ht/4), (x, y+3*ht/4)], fc, oc, lt)
         else:
-            self.out += '  <polygon fill="%s" stroke="%s" stroke-width="%f"\n' % (colorstr(fc), colorstr(oc), lt)
-            self.out += '           points="%f,%f %f,%f %f,%f" />\n' % (x, y, x, y+ht, x + wid, y1)
+            self.drawPolygon([(x, y), (x, y+ht), (x + wid, y1)], fc, oc, lt)
 
     def drawLeftArrow(self, x, y, wid, ht, fc, oc=(0,0,0), lt=1):
         if lt > ht /2:
@@ -154,100 +510,139 @@ class scalableVectorGraphics:
         x2 = x + ht / 2
         ht -= 1
         if wid > ht/2:
-            self.out += '  <polygon fill="%s" stroke="%s" stroke-width="%f"\n' % (colorstr(fc), colorstr(oc), lt)
-            self.out += '           points="%f,%f %f,%f %f,%f %f,%f %f,%f %f,%f %f,%f" />\n' % (x1, y+ht/4, x2, y+ht/4,
-                                                                                                x2, y, x, y1, x2, y+ht,
-                                                                                                x2, y+3*ht/4, x1, y+3*ht/4)
+            self.drawPolygon([(x1, y+ht/4), (x2, y+ht/4), (x2, y), (x, y1), (x2, y+ht), (x2, y+3*ht/4), (x1, y+3*ht/4)], fc, oc, lt)
         else:
-            self.out += '  <polygon fill="%s" stroke="%s" stroke-width="%f"\n' % (colorstr(fc), colorstr(oc), lt)
-            self.out += '           points="%f,%f %f,%f %f,%f" />\n' % (x, y1, x1, y+ht, x1, y)
+            self.drawPolygon([(x, y1), (x1, y+ht), (x1, y)], fc, oc, lt)
 
 
     def drawOutRect(self, x1, y1, wid, hei, fill=(255, 255, 255), outfill=(0, 0, 0), lt=1, alpha=1.0, alpha2=1.0):
-        self.out += '  <rect stroke="%s" stroke-width="%f" stroke-opacity="%f"\n' % (colorstr(outfill), lt, alpha)
-        self.out += '        fill="%s" fill-opacity="%f"\n' % (colorstr(fill), alpha2)
-        self.out += '        x="%f" y="%f" width="%f" height="%f" />\n' % (x1, y1, wid, hei)
+        # rectangles without area aren't rendered
+        if wid <= 0 or hei <= 0:
+            return
+        cls = self.style_class('stroke:%s;stroke-width:%spx;stroke-opacity:%s;fill:%s;fill-opacity:%s' % (colorstr(outfill), numstr(lt), numstr(alpha), colorstr(fill), numstr(alpha2)))
+        self.parts.append('<rect class="%s" x="%s" y="%s" width="%s" height="%s"/>\n' % (cls, numstr(x1), numstr(y1), numstr(wid), numstr(hei)))
 
     def create_pattern(self, id, fill, pattern, width, line_width):
         fill = colorstr(fill)
         if pattern == 'horizontal':
-            self.out += '    <defs>\n'
-            self.out += '      <pattern id="%s" width="%d" height="%d" patternUnits="userSpaceOnUse">\n' % (id, width, width)
-            self.out += '        <line x1="0" y1="0" x2="%d" y2="0" style="stroke:%s; stroke-width:%d; fill:#FFFFFF" />\n' % (width, fill, line_width)
-            self.out += '      </pattern>\n'
-            self.out += '   </defs>\n'
+            self.defs.append('<defs><pattern id="%s" width="%d" height="%d" patternUnits="userSpaceOnUse">'
+                             '<line x1="0" y1="0" x2="%d" y2="0" style="stroke:%s; stroke-width:%d; fill:#FFFFFF" /></pattern></defs>\n'
+                             % (id, width, width, width, fill, line_width))
         elif pattern == 'forward_diag':
-            self.out += '    <defs>\n'
-            self.out += '      <pattern id="%s" width="%d" height="%d" patternTransform="rotate(45 0 0)" patternUnits="userSpaceOnUse">\n' % (id, width, width)
-            self.out += '        <line x1="0" y1="0" x2="0" y2="%d" style="stroke:%s; stroke-width:%d; fill:#FFFFFF" />\n' % (width, fill, line_width)
-            self.out += '      </pattern>\n'
-            self.out += '   </defs>\n'
+            self.defs.append('<defs><pattern id="%s" width="%d" height="%d" patternTransform="rotate(45 0 0)" patternUnits="userSpaceOnUse">'
+                             '<line x1="0" y1="0" x2="0" y2="%d" style="stroke:%s; stroke-width:%d; fill:#FFFFFF" /></pattern></defs>\n'
+                             % (id, width, width, width, fill, line_width))
         elif pattern == 'reverse_diag':
-            self.out += '    <defs>\n'
-            self.out += '      <pattern id="%s" width="%d" height="%d" patternTransform="rotate(135 0 0)" patternUnits="userSpaceOnUse">\n' % (id, width, width)
-            self.out += '        <line x1="0" y1="0" x2="0" y2="%d" style="stroke:%s; stroke-width:%d; fill:#FFFFFF" />\n' % (width, fill, line_width)
-            self.out += '      </pattern>\n'
-            self.out += '   </defs>\n'
+            self.defs.append('<defs><pattern id="%s" width="%d" height="%d" patternTransform="rotate(135 0 0)" patternUnits="userSpaceOnUse">'
+                             '<line x1="0" y1="0" x2="0" y2="%d" style="stroke:%s; stroke-width:%d; fill:#FFFFFF" /></pattern></defs>\n'
+                             % (id, width, width, width, fill, line_width))
 
     # create a rectangle with a patterned fill. Pattern needs to be created with  create_pattern first
     def drawPatternRect(self, x, y, width, height, id, fill, title="none", webpage="none", lt=1):
         fill = colorstr(fill)
-        self.out += '  <rect style="fill:#FFFFFF; stroke: %s; stroke-alignment: inner;"\n' % fill
-        self.out += '        x="%d" y="%d" width="%d" height="%d"  />\n' % (x, y, width, height)
-        self.out += '  <a href="%s">' % webpage
-        self.out += '  <rect style="fill:url(#%s); stroke: %s; stroke-alignment: inner;"\n' % (id, fill)
-        self.out += '        x="%d" y="%d" width="%d" height="%d"> <title>%s</title> </rect>\n' % (x, y, width, height, title)
-        self.out += '  </a>'
+        self.parts.append('<rect style="fill:#FFFFFF; stroke: %s; stroke-alignment: inner;" x="%d" y="%d" width="%d" height="%d"/>\n'
+                          '<a href="%s"><rect style="fill:url(#%s); stroke: %s; stroke-alignment: inner;" x="%d" y="%d" width="%d" height="%d">'
+                          '<title>%s</title></rect></a>\n' % (fill, x, y, width, height, webpage, id, fill, x, y, width, height, escape(title)))
+
+    # a rectangle defined once and placed many times with drawUse
+    def defineRect(self, id, wid, hei):
+        self.defs.append('<defs><rect id="%s" width="%s" height="%s"/></defs>\n' % (id, numstr(wid), numstr(hei)))
+
+    def drawUse(self, id, x, y, fill=(255, 255, 255), alpha=1.0):
+        cls = self.style_class('stroke:none;fill:%s;fill-opacity:%s' % (colorstr(fill), numstr(alpha)))
+        # xlink:href rather than href, SVG 1.1 renderers ignore the plain attribute
+        self.parts.append('<use xlink:href="#%s" class="%s" x="%s" y="%s"/>\n' % (id, cls, numstr(x), numstr(y)))
 
 
     def writeString(self, thestring, x, y, size, ital=False, bold=False, rotate=0, justify='left', color=(0,0,0)):
         if rotate != 0:
             x, y = y, x
-        self.out += '  <text\n'
-        self.out += '    style="font-size:%fpx;font-style:normal;font-weight:normal;z-index:10\
-;line-height:125%%;letter-spacing:0px;word-spacing:0px;fill:%s;fill-opacity:1;stroke:none;font-family:sans-serif"\n' % (size, colorstr(color))
-        if justify == 'right':
-            self.out += '    text-anchor="end"\n'
-        elif justify == 'middle':
-            self.out += '    text-anchor="middle"\n'
-        if rotate == 1:
-            self.out += '    x="-%f"\n' % x
-        else:
-            self.out += '    x="%f"\n' % x
-        if rotate == -1:
-            self.out += '    y="-%f"\n' % y
-        else:
-            self.out += '    y="%f"\n' % y
-        self.out += '    sodipodi:linespacing="125%"'
-        if rotate == -1:
-            self.out += '\n    transform="matrix(0,1,-1,0,0,0)"'
-        if rotate == 1:
-            self.out += '\n    transform="matrix(0,-1,1,0,0,0)"'
-        self.out += '><tspan\n      sodipodi:role="line"\n'
         if rotate == 1:
-            self.out += '      x="-%f"\n' % x
-        else:
-            self.out += '      x="%f"\n' % x
-        if rotate == -1:
-            self.out += '      y="-%f"' % y
-        else:
-            self.out += '      y="%f"' % y
+            x = -x
+        elif rotate == -1:
+            y = -y
+        style = 'font-size:%spx;fill:%s' % (numstr(size), colorstr(color))
         if ital and bold:
-            self.out += '\nstyle="font-style:italic;font-weight:bold"'
+            style += ';font-style:italic;font-weight:bold'
         elif ital:
-            self.out += '\nstyle="font-style:italic"'
+            style += ';font-style:italic'
         elif bold:
-            self.out += '\nstyle="font-style:normal;font-weight:bold"'
-        self.out += '>' + thestring + '</tspan></text>\n'
+            style += ';font-weight:bold'
+        if justify == 'right':
+            style += ';text-anchor:end'
+        elif justify == 'middle':
+            style += ';text-anchor:middle'
+        cls = self.style_class(style)
+        if rotate == -1:
+            transform = ' transform="matrix(0,1,-1,0,0,0)"'
+        elif rotate == 1:
+            transform = ' transform="matrix(0,-1,1,0,0,0)"'
+        else:
+            transform = ''
+        self.parts.append('<text class="t %s" x="%s" y="%s"%s>%s</text>\n' % (cls, numstr(x), numstr(y), transform, escape(thestring)))
+
+
+SARS_COV_2_GENES = [
+    ["ORF1a", 266, 13468],
+    ["ORF1b", 13468, 21555],
+    ["spike", 21563, 25384],
+    ["ORF3a", 25393, 26220],
+    ["E", 26245, 26472],
+    ["M", 26523, 27191],
+    ["ORF6", 27202, 27387],
+    ["ORF7a", 27394, 27759],
+    ["ORF8", 27894, 28259],
+    ["N", 28274, 29533],
+    ["ORF10", 29558,29674]
+]
 
+# genes drawn on the genome bar, by contig
+GENES = {"MN908947.3": SARS_COV_2_GENES, "NC_045512.2": SARS_COV_2_GENES}
 
-def draw_output(positions, proportion, depths, names, bases, output_file, varA, varB, refseq, panelC):
+
+def draw_output(positions, proportion, counts, names, output_file, varA, varB, ref_bases, panelC, site_contigs=None, contig_lengths=None,
+                intervals=None, lineages=None, frequencies=None, defining=None, mixture=None, linkage=None, coverage=None, coverage_bin=100):
+    svg = build_svg(positions, proportion, counts, names, varA, varB, ref_bases, panelC, site_contigs, contig_lengths, intervals, lineages,
+                    frequencies, defining, mixture, linkage, coverage, coverage_bin)
+    return svg.element_count(), svg.writesvg(output_file)
+
+
+def build_svg(positions, proportion, counts, names, varA, varB, ref_bases, panelC, site_contigs=None, contig_lengths=None, intervals=None,
+              lineages=None, frequencies=None, defining=None, mixture=None, linkage=None, coverage=None, coverage_bin=100):
+    # contigs are drawn end to end on the genome bar in the order of contig_lengths,
+    # intervals (lower and upper bound of each proportion) are drawn as whiskers at the end of each bar segment.
+    # With lineages the variant 1/2 proportions are replaced by a panel per lineage with the frequency of its allele at each
+    # site (coloured where it differs from the reference) and a line at its estimated proportion in the mixture.
+    # linkage is a list of (site, site, r squared, D) drawn as a triangle of diamonds below the other panels.
+    # coverage has the min, mean and max depth of each bin of coverage_bin columns by contig (from bin_coverage),
+    # drawn on a log scale along the genome at the bottom
+    if contig_lengths is None:
+        contig_lengths = [(DEFAULT_CONTIG, 29903)]
+    if site_contigs is None:
+        site_contigs = [contig_lengths[0][0]] * len(positions)
+    offsets = {}
+    length = 0
+    for contig, contig_length in contig_lengths:
+        offsets[contig] = length
+        length += contig_length
+    depths = counts.sum(axis=1)
+    # panel 3 draws A, T, C, G and deletions
+    with np.errstate(divide="ignore", invalid="ignore"):
+        bases = np.nan_to_num(counts[:, [0, 3, 1, 2, 5]] / depths[:, None])
     left_buffer = 5
     page_width = max([210, len(positions)*10])
     if panelC:
         page_height = 600
     else:
         page_height = 320
+    proportion_height = 100
+    lineage_height = 40
+    lineage_gap = 6
+    if lineages is None:
+        panel_height = proportion_height
+    else:
+        panel_height = len(lineages) * (lineage_height + lineage_gap)
+        page_height += panel_height - proportion_height
     svg = scalableVectorGraphics(page_height, page_width)
     right_buffer = 40
     width = page_width - left_buffer - right_buffer
@@ -256,27 +651,17 @@ def draw_output(positions, proportion, depths, names, bases, output_file, varA,
     height = 30
     line_width = 6
     svg.drawLine(left_buffer, y, left_buffer+width, y, line_width)
-    length = 29903
-    genes = [
-		["ORF1a", 266, 13468],
-        ["ORF1b", 13468, 21555],
-        ["spike", 21563, 25384],
-        ["ORF3a", 25393, 26220],
-        ["E", 26245, 26472],
-        ["M", 26523, 27191],
-        ["ORF6", 27202, 27387],
-        ["ORF7a", 27394, 27759],
-		["ORF8", 27894, 28259],
-        ["N", 28274, 29533],
-        ["ORF10", 29558,29674]
-    ]
-    for i in genes:
-        name, start, stop = i
-        x = left_buffer + start/length*width
-        gene_width = (stop-start)/length*width
-        svg.drawRightArrow(x, y-height/2+0.5, gene_width, height, (3, 166, 41))
-        if gene_width > 10:
-            svg.writeString(name, x+2, y+8/3, 8, color=(255, 255, 255))
+    for contig, contig_length in contig_lengths:
+        if offsets[contig] > 0:
+            x = left_buffer + offsets[contig]/length*width
+            svg.drawLine(x, y-height/2, x, y+height/2, 2)
+        for i in GENES.get(contig, []):
+            name, start, stop = i
+            x = left_buffer + (offsets[contig] + start)/length*width
+            gene_width = (stop-start)/length*width
+            svg.drawRightArrow(x, y-height/2+0.5, gene_width, height, (3, 166, 41))
+            if gene_width > 10:
+                svg.writeString(name, x+2, y+8/3, 8, color=(255, 255, 255))
     spacer = 5
     column_width = (width - (len(positions)-1)*spacer)/len(positions)
     colors = [(127,163,74),
@@ -288,10 +673,16 @@ def draw_output(positions, proportion, depths, names, bases, output_file, varA,
                (149,115,198),
                (204,109,65),
                (153, 153, 153)]
+    lineage_colors = [(127,163,74),
+                      (149,115,198),
+                      (204,109,65),
+                      (52,116,235),
+                      (153,86,107),
+                      (230,171,2),
+                      (27,158,119),
+                      (231,41,138)]
 
-    proportion_height = 100
-
-    y3 = proportion_height + y2 + height + 1
+    y3 = panel_height + y2 + height + 1
     y4 = y3 + 30
     y5 = y4+130
     if len(positions) > 15:
@@ -301,22 +692,31 @@ def draw_output(positions, proportion, depths, names, bases, output_file, varA,
     else:
         font_size = 6
     for num, i in enumerate(positions):
-        print(num, i)
-        x1 = left_buffer + i/length*width
+        x1 = left_buffer + (offsets[site_contigs[num]] + i)/length*width
         x2 = left_buffer + num/len(positions) * width + column_width/2
         svg.drawPath([x1, x1, x2, x2], [y-height/2, y+height/2, y2, y2+height/2])
         svg.writeString(str(i), x2-font_size/3, y2+height/2+1, font_size, rotate=-1)# justify="middle")
         prop_y = y2 + height
-        for num2, j in enumerate(proportion[num]):
+        for num2 in range(0 if lineages is None else len(lineages)):
+            col_height = frequencies[num][num2] * lineage_height
+            lineage_y = prop_y + num2 * (lineage_height + lineage_gap) + lineage_height
+            color = lineage_colors[num2 % len(lineage_colors)] if defining[num][num2] else (153, 153, 153)
+            svg.drawOutRect(x2-column_width/2, lineage_y - col_height, column_width, col_height, color, lt=0)
+        for num2, j in enumerate(proportion[num] if lineages is None else []):
             col_height = j * proportion_height
             svg.drawOutRect(x2-column_width/2, prop_y, column_width, col_height, colors[num2], lt=0)
+            if intervals is not None and j > 0:
+                x3 = x2 - column_width/2 + (num2 + 1) * column_width/5
+                lower, upper = intervals[num][num2]
+                bottom = y2 + height + proportion_height
+                svg.drawLine(x3, min(prop_y + lower * proportion_height, bottom), x3, min(prop_y + upper * proportion_height, bottom), 0.5)
             prop_y += col_height
         svg.writeString(names[num], x2-font_size/3, y3, font_size, rotate=-1)# justify="middle")
         col_height = min([depths[num]/1000 * 100, 100])
         svg.drawOutRect(x2-column_width/2, y4, column_width, col_height, (52, 116, 235), lt=0)
         svg.writeString(str(depths[num]) + "x", x2-font_size/3, y4+col_height+1, font_size, rotate=-1)#, justify="middle")
         if panelC:
-            svg.writeString(refseq[i - 1].upper(), x2, y5-1, font_size, justify="middle")
+            svg.writeString(ref_bases[num], x2, y5-1, font_size, justify="middle")
             prop_y = y5
             for num2, j in enumerate(bases[num]):
                 col_height = j * proportion_height
@@ -343,113 +743,1648 @@ def draw_output(positions, proportion, depths, names, bases, output_file, varA,
     svg.drawLine(left_buffer, y4+100, left_buffer + width, y4+100)
     svg.writeString("1000x", left_buffer+width+2, y4+100, 6)
     svg.writeString("Depth", page_width-right_buffer, y4 + 50, 10, justify="middle", rotate=-1)
-    svg.writeString("Legend", page_width-right_buffer, y2+height, 10)
-    svg.drawOutRect(page_width-right_buffer, y2+height+6, 10, 10, colors[0], lt=0)
-    svg.writeString(varA, page_width-right_buffer+11, y2+height+14, 8)
-    svg.drawOutRect(page_width-right_buffer, y2+height+18, 10, 10, colors[1], lt=0)
-    svg.writeString(varB, page_width-right_buffer+11, y2+height+26, 8)
-    svg.drawOutRect(page_width-right_buffer, y2+height+30, 10, 10, colors[2], lt=0)
-    svg.writeString("both", page_width-right_buffer+11, y2+height+38, 8)
-    svg.drawOutRect(page_width-right_buffer, y2+height+42, 10, 10, colors[3], lt=0)
-    svg.writeString("other", page_width-right_buffer+11, y2+height+50, 8)
+    if lineages is not None:
+        for num2, lineage in enumerate(lineages):
+            lineage_y = y2 + height + num2 * (lineage_height + lineage_gap)
+            color = lineage_colors[num2 % len(lineage_colors)]
+            svg.drawLine(left_buffer, lineage_y + lineage_height, left_buffer + width, lineage_y + lineage_height, 0.5)
+            mixture_y = lineage_y + lineage_height * (1 - mixture[num2])
+            svg.drawLine(left_buffer, mixture_y, left_buffer + width, mixture_y, 0.5, color)
+            svg.writeString(lineage, left_buffer+width+2, lineage_y + 8, 8, color=color)
+            svg.writeString("%.1f%%" % (mixture[num2] * 100), left_buffer+width+2, lineage_y + 18, 8)
+    else:
+        svg.writeString("Legend", page_width-right_buffer, y2+height, 10)
+        svg.drawOutRect(page_width-right_buffer, y2+height+6, 10, 10, colors[0], lt=0)
+        svg.writeString(varA, page_width-right_buffer+11, y2+height+14, 8)
+        svg.drawOutRect(page_width-right_buffer, y2+height+18, 10, 10, colors[1], lt=0)
+        svg.writeString(varB, page_width-right_buffer+11, y2+height+26, 8)
+        svg.drawOutRect(page_width-right_buffer, y2+height+30, 10, 10, colors[2], lt=0)
+        svg.writeString("both", page_width-right_buffer+11, y2+height+38, 8)
+        svg.drawOutRect(page_width-right_buffer, y2+height+42, 10, 10, colors[3], lt=0)
+        svg.writeString("other", page_width-right_buffer+11, y2+height+50, 8)
+    bottom = (y5 + proportion_height if panelC else y4 + 110) + 10
+    if linkage is not None:
+        # the diamond of a pair sits below the midpoint of its columns, further down the further apart they are
+        y6 = bottom
+        half = width / len(positions) / 2
+        max_apart = max([abs(j - i) for i, j, r2, d in linkage], default=1)
+        bottom = max(y6 + (max_apart + 1) * half + 10, y6 + 60)
+        linkage_colors = [(204,109,65),
+                          (52,116,235)]
+        for i, j, r2, d in linkage:
+            cx = left_buffer + (i + j) / 2 / len(positions) * width + column_width/2
+            cy = y6 + abs(j - i) * half
+            color = linkage_colors[0] if d > 0 else linkage_colors[1]
+            # ten shades so that the diamonds share a few css classes
+            shade = round(r2 * 10) / 10
+            fill = tuple(int(round(255 + (k - 255) * shade)) for k in color)
+            svg.drawPolygon([(cx, cy - half), (cx + half, cy), (cx, cy + half), (cx - half, cy)], fill, fill, lt=0)
+        svg.writeString("Linkage", page_width-right_buffer, y6 + 8, 10)
+        svg.drawOutRect(page_width-right_buffer, y6 + 14, 10, 10, linkage_colors[0], lt=0)
+        svg.writeString("cis", page_width-right_buffer+11, y6 + 22, 8)
+        svg.drawOutRect(page_width-right_buffer, y6 + 26, 10, 10, linkage_colors[1], lt=0)
+        svg.writeString("trans", page_width-right_buffer+11, y6 + 34, 8)
+        svg.writeString("shade: r\u00b2", page_width-right_buffer, y6 + 46, 6)
+    if coverage is not None:
+        y7 = bottom + 10
+        coverage_height = 50
+        top_depth = max([stat[2].max(initial=0) for stat in coverage.values()] + [1])
+        scale = coverage_height / np.log10(top_depth + 1)
+        coverage_colors = [(153, 86, 107),
+                           (52, 116, 235),
+                           (153, 153, 153)]
+        xcoords = []
+        for contig, contig_length in contig_lengths:
+            if contig in coverage:
+                centres = np.minimum((np.arange(coverage[contig].shape[1]) + 0.5) * coverage_bin, contig_length)
+                xcoords.append(left_buffer + (offsets[contig] + centres) / length * width)
+        if xcoords:
+            xcoords = np.concatenate(xcoords)
+            for num in (2, 1, 0):
+                depth = np.concatenate([coverage[contig][num] for contig, contig_length in contig_lengths if contig in coverage])
+                svg.drawPath(xcoords, y7 + coverage_height - np.log10(depth + 1) * scale, 1, coverage_colors[num])
+        svg.drawLine(left_buffer, y7 + coverage_height, left_buffer + width, y7 + coverage_height, 0.5)
+        svg.writeString("0x", left_buffer+width+2, y7 + coverage_height, 6)
+        svg.writeString("%dx" % top_depth, left_buffer+width+2, y7 + 4, 6)
+        svg.writeString("Coverage", page_width-right_buffer, y7 + 16, 8)
+        for num, name in enumerate(["min", "mean", "max"]):
+            svg.drawLine(page_width-right_buffer, y7 + 23 + num * 10, page_width-right_buffer+10, y7 + 23 + num * 10, 2, coverage_colors[num])
+            svg.writeString(name, page_width-right_buffer+12, y7 + 26 + num * 10, 8)
+        bottom = y7 + coverage_height + 20
+    if linkage is not None or coverage is not None:
+        svg.height = max(page_height, bottom)
+
+
+
+
+
+    return svg
+
+
+def cohort_matrix(samples):
+    # samples are (name, sites, fraction, depth), sites are [name, position, contig].
+    # Returns the union of the sites (by contig then position) and samples x sites arrays of fraction and depth,
+    # depth is 0 where a sample doesn't have the site
+    contig_order = {}
+    names = {}
+    for sample, sites, fraction, depth in samples:
+        for name, pos, contig in sites:
+            contig_order.setdefault(contig, len(contig_order))
+            names.setdefault((contig, pos), name)
+    keys = sorted(names, key=lambda i: (contig_order[i[0]], i[1]))
+    column = {key: num for num, key in enumerate(keys)}
+    fractions = np.zeros((len(samples), len(keys)))
+    depths = np.zeros((len(samples), len(keys)), dtype=np.int64)
+    for row, (sample, sites, fraction, depth) in enumerate(samples):
+        cols = [column[(i[2], i[1])] for i in sites]
+        fractions[row, cols] = fraction
+        depths[row, cols] = depth
+    return [[names[key], key[1], key[0]] for key in keys], fractions, depths
+
+
+def bin_rows(labels, fractions, depths, max_rows):
+    # merge neighbouring rows so there are at most max_rows, the fraction of a bin is weighted by depth
+    if len(labels) <= max_rows:
+        return labels, fractions, depths
+    edges = np.linspace(0, len(labels), max_rows + 1).round().astype(np.intp)
+    starts = edges[:-1]
+    sizes = np.diff(edges)
+    depth_sum = np.add.reduceat(depths, starts, axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        binned = np.nan_to_num(np.add.reduceat(fractions * depths, starts, axis=0) / depth_sum)
+    labels = ["%s - %s" % (labels[start], labels[start + size - 1]) if size > 1 else labels[start] for start, size in zip(starts, sizes)]
+    return labels, binned, depth_sum // sizes[:, None]
+
+
+def build_cohort_svg(labels, sites, fractions, depths, varA, varB, max_height=1000):
+    # one row per sample and one column per site coloured from variant 2 to variant 1 by the fraction of reads with the
+    # variant 1 allele, faded where the depth is low (blank without reads). Rows are binned to fit in max_height pixels
+    labels, fractions, depths = bin_rows(labels, fractions, depths, max_height)
+    num_rows, num_cols = fractions.shape
+    # whole pixels so neighbouring cells don't leave seams
+    row_height = min(10, max(1, max_height // max(num_rows, 1)))
+    cell_width = min(10, max(2, 1000 // max(num_cols, 1)))
+    label_width = 60 if row_height >= 4 else 5
+    top = 40
+    right_buffer = 60
+    width = num_cols * cell_width
+    page_width = label_width + width + right_buffer
+    page_height = max(top + num_rows * row_height + 10, 180)
+    svg = scalableVectorGraphics(page_height, page_width)
+    colors = [(127,163,74),
+              (149, 115, 198)]
+    steps = 10
+    # fraction is drawn in steps+1 colours and depth in 4 opacities so the cells share a few css classes
+    ramp = [tuple(int(round(colors[1][k] + (colors[0][k] - colors[1][k]) * j / steps)) for k in range(3)) for j in range(steps + 1)]
+    depth_bins = [10, 100, 1000]
+    alphas = [0.25, 0.5, 0.75, 1.0]
+    svg.defineRect("c", cell_width, row_height)
+    font_size = min(6, cell_width)
+    for num, i in enumerate(sites):
+        x = label_width + num * cell_width + cell_width / 2
+        svg.writeString(str(i[1]), x - font_size/3, top - 2, font_size, rotate=-1, justify="right")
+    fraction_step = np.clip(np.round(fractions * steps).astype(np.intp), 0, steps)
+    alpha_index = np.searchsorted(depth_bins, depths, side="right")
+    for row in range(num_rows):
+        y = top + row * row_height
+        if row_height >= 4:
+            svg.writeString(labels[row], label_width - 2, y + row_height - 1, min(6, row_height), justify="right")
+        for col in np.flatnonzero(depths[row]):
+            svg.drawUse("c", label_width + col * cell_width, y, ramp[fraction_step[row, col]], alphas[alpha_index[row, col]])
+    legend_x = label_width + width + 5
+    svg.writeString(varA, legend_x, top - 2, 8, color=colors[0])
+    for j in range(steps + 1):
+        svg.drawOutRect(legend_x, top + j * 5, 10, 5, ramp[steps - j], lt=0)
+    svg.writeString(varB, legend_x, top + (steps + 1) * 5 + 8, 8, color=colors[1])
+    y = top + (steps + 1) * 5 + 20
+    svg.writeString("Depth", legend_x, y, 8)
+    for num, alpha in enumerate(alphas):
+        svg.drawOutRect(legend_x, y + 3 + num * 12, 10, 10, colors[0], lt=0, alpha2=alpha)
+        label = "<%dx" % depth_bins[num] if num < len(depth_bins) else ">=%dx" % depth_bins[-1]
+        svg.writeString(label, legend_x + 12, y + 11 + num * 12, 6)
+    return svg
+
+
+def draw_cohort(samples, output_file, varA, varB, max_height=1000):
+    labels = [i[0] for i in samples]
+    sites, fractions, depths = cohort_matrix(samples)
+    svg = build_cohort_svg(labels, sites, fractions, depths, varA, varB, max_height)
+    return svg.element_count(), svg.writesvg(output_file)
+
+
+def count_window(samfile, start, stop, contig=DEFAULT_CONTIG, sample_depth=None, seed=0, pileup=None, saturated=None, kept=None,
+                 depth=None):
+    # allele counts for every column in [start, stop) and whether the pileup visited it,
+    # saturated can be a boolean array for the window, set where the pileup hit max_depth,
+    # kept can be an int array for the window, set to the number of reads each column was counted from (fewer than the
+    # depth where they were sampled). depth can be the fragment_depth of the window for sample_window
+    if pileup is None:
+        pileup = DEFAULT_PILEUP
+    if sample_depth is not None:
+        sampled = sample_window(samfile, start, stop, contig, sample_depth, seed, pileup, depth)
+        if sampled is not None:
+            if kept is not None:
+                kept[:] = sampled[2]
+            return sampled[:2]
+    counts = np.zeros((stop - start, len(BASES)), dtype=np.int64)
+    covered = np.zeros(stop - start, dtype=bool)
+    depth = np.zeros(stop - start, dtype=np.int64)
+    for pileupcolumn in samfile.pileup(contig, start, stop, truncate=True, **pileup):
+        pos = pileupcolumn.reference_pos - start
+        counts[pos] = count_column(pileupcolumn)
+        covered[pos] = True
+        depth[pos] = pileupcolumn.nsegments
+    if saturated is not None and can_truncate(depth.max(initial=0), pileup):
+        saturated |= depth < span_depth(samfile, contig, start, stop, pileup["min_mapping_quality"])
+    if kept is not None:
+        kept[:] = counts.sum(axis=1)
+    return counts, covered
+
+
+def _count_window_worker(args):
+    bam_file, contig, start, stop, sample_depth, seed, pileup, depth = args
+    saturated = np.zeros(stop - start, dtype=bool)
+    kept = np.zeros(stop - start, dtype=np.int64)
+    with pysam.AlignmentFile(bam_file, "rb") as samfile:
+        counts, covered = count_window(samfile, start, stop, contig, sample_depth, seed, pileup, saturated, kept, depth)
+    return start, counts, covered, saturated, kept
 
 
+MIN_WINDOW = 1000
 
 
+def count_genome(alignment, contig=DEFAULT_CONTIG, processes=1, window_size=None, sample_depth=None, seed=0, pileup=None, saturated=None,
+                 kept=None, depth=None):
+    # saturated can be a boolean array for the contig, set where the pileup hit max_depth, kept an int array for the contig,
+    # set to the number of reads each column was counted from. depth is genome_coverage of the contig, looked up when
+    # sampling without it.
+    # By default the contig is split into about four windows per process (at least MIN_WINDOW bp, reads crossing a
+    # window edge are read by both windows) so the pool stays busy, and 5000 bp windows when counting in one process
+    if pileup is None:
+        pileup = DEFAULT_PILEUP
+    length = alignment.get_reference_length(contig)
+    if window_size is None:
+        window_size = max(-(-length // (processes * 4)), MIN_WINDOW) if processes > 1 else 5000
+    counts = np.zeros((length, len(BASES)), dtype=np.int64)
+    covered = np.zeros(length, dtype=bool)
+    if saturated is None:
+        saturated = np.zeros(length, dtype=bool)
+    if kept is None:
+        kept = np.zeros(length, dtype=np.int64)
+    windows = [(start, min(start + window_size, length)) for start in range(0, length, window_size)]
+    # sampled windows share one samtools depth pass over the contig
+    if sample_depth is None:
+        depth = None
+    elif depth is None:
+        depth = genome_coverage(alignment, contig, pileup["min_mapping_quality"], pileup["min_base_quality"])
+    if processes > 1:
+        jobs = [(alignment.filename, contig, start, stop, sample_depth, seed, pileup, None if depth is None else depth[start:stop])
+                for start, stop in windows]
+        with multiprocessing.Pool(processes) as pool:
+            for start, window_counts, window_covered, window_saturated, window_kept in pool.imap_unordered(_count_window_worker, jobs):
+                counts[start:start + len(window_counts)] = window_counts
+                covered[start:start + len(window_covered)] = window_covered
+                saturated[start:start + len(window_saturated)] = window_saturated
+                kept[start:start + len(window_kept)] = window_kept
+    else:
+        for start, stop in windows:
+            counts[start:stop], covered[start:stop] = count_window(alignment, start, stop, contig, sample_depth, seed, pileup,
+                                                                   saturated[start:stop], kept[start:stop],
+                                                                   None if depth is None else depth[start:stop])
+    return counts, covered
+
 
-    svg.writesvg(output_file)
+def minor_sites(counts, covered, all_minor_fraction, all_minor_depth):
+    # columns where at least two alleles reach the minor fraction, with enough depth
+    depth = counts.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        good = (counts / depth[:, None] >= all_minor_fraction).sum(axis=1)
+    return covered & (depth >= all_minor_depth) & (good >= 2)
 
 
-def get_minor(sites, alignment, refseq, all_minor_fraction, all_minor_depth):
+def select_minor(sites, counts, covered, reference, all_minor_fraction, all_minor_depth, contig=DEFAULT_CONTIG):
+    # counts and covered are for contig, sites on other contigs are left out
     site_dict = {}
     for i in sites:
-        site_dict[i[1]] = i
+        if i[4] == contig:
+            site_dict[i[1]] = i
+    known = np.zeros(len(covered), dtype=bool)
+    known[[pos - 1 for pos in site_dict if 0 < pos <= len(known)]] = True
+    minor = minor_sites(counts, covered, all_minor_fraction, all_minor_depth)
     sites = []
-    for pileupcolumn in alignment.pileup("MN908947.3"):
-        pos = pileupcolumn.reference_pos
-        ref_base = refseq[pos].upper()
-
-        basefreq = defaultdict(lambda: 0)
-        depth = 0
-        if pos in site_dict:
-            sites.append(site_dict[pos])
+    for pos in np.flatnonzero(covered & (known | minor)):
+        if known[pos]:
+            sites.append(site_dict[pos+1])
         else:
-            for pileupread in pileupcolumn.pileups:
-                if pileupread.is_del:
-                    basefreq["-"] += 1
-                    depth += 1
-                elif pileupread.is_refskip:
-                    pass
-                else:
-                    base = pileupread.alignment.query_sequence[pileupread.query_position]
-                    base = base.upper()
-                    basefreq[base] += 1
-                    depth += 1
-            if depth < all_minor_depth:
-                continue
-            good = 0
-            for i in basefreq:
-                if basefreq[i] / depth >= all_minor_fraction:
-                    good += 1
-            if good >= 2:
-                sites.append(["ref", pos+1, ref_base, ref_base])
+            ref_base = reference.fetch(contig, int(pos), int(pos)+1).upper()
+            sites.append(["ref", int(pos)+1, ref_base, ref_base, contig])
     return(sites)
 
 
-def __main__(bam_file, variantA, variantB, output_file, all_variants, all_minor, all_minor_fraction, all_minor_cov, panel3):
+def get_minor(sites, alignment, reference, all_minor_fraction, all_minor_depth, processes=1, stats=None, contigs=None, sample_depth=None,
+              seed=0, pileup=None):
+    if contigs is None:
+        contigs = detect_contigs(alignment, reference)
+    minor = []
+    for contig in contigs:
+        saturated = np.zeros(alignment.get_reference_length(contig), dtype=bool)
+        kept = np.zeros(alignment.get_reference_length(contig), dtype=np.int64)
+        counts, covered = count_genome(alignment, contig, processes, sample_depth=sample_depth, seed=seed, pileup=pileup,
+                                       saturated=saturated, kept=kept)
+        if stats is not None:
+            stats.add("minor_columns_visited", covered.sum())
+            stats.add("minor_reads_inspected", kept.sum())
+            stats.add("minor_columns_saturated", saturated.sum())
+        minor += select_minor(sites, counts, covered, reference, all_minor_fraction, all_minor_depth, contig)
+    return minor
+
+
+# reads skipped by pileup: unmapped, secondary, qc fail and duplicate
+PILEUP_SKIP_FLAGS = 4 | 256 | 512 | 1024
+
+
+def pileup_skips(read, min_mapping_quality=0):
+    # whether the pileup leaves read out: PILEUP_SKIP_FLAGS, orphans (paired but not in a proper pair, pysam's
+    # ignore_orphans) and mapping quality below min_mapping_quality
+    return bool(read.flag & PILEUP_SKIP_FLAGS) or read.flag & 3 == 1 or read.mapping_quality < min_mapping_quality
+
+
+# samtools options selecting the orphans pileup_skips leaves out
+ORPHANS_ONLY = ("--require-flags", "PAIRED", "-G", "PROPER_PAIR")
+
+
+def fragment_depth(alignment, contig, start, stop, min_mapping_quality=0, min_base_quality=13):
+    # reads covering each column of [start, stop) from samtools depth, which is about twice as fast as walking the aligned
+    # blocks of every read in python. Like the allele counts it counts overlapping mates once, includes deletions and leaves
+    # out bases below min_base_quality (where mates overlap samtools checks one base rather than the summed quality,
+    # so it can be a little lower). Unlike the pileup counts it has no depth limit and is never sampled, orphans are
+    # taken off as in span_depth
+    options = ("-s", "-q", str(min_base_quality), "-Q", str(min_mapping_quality))
+    return samtools_depth(alignment, contig, start, stop, *options) - samtools_depth(alignment, contig, start, stop, *options, *ORPHANS_ONLY)
+
+
+def genome_coverage(alignment, contig, min_mapping_quality=0, min_base_quality=13):
+    # fragment_depth of the whole contig
+    return fragment_depth(alignment, contig, 0, alignment.get_reference_length(contig), min_mapping_quality, min_base_quality)
+
+
+def span_depth(alignment, contig, start, stop, min_mapping_quality=0):
+    # reads spanning each column of [start, stop) with no depth limit, deletions included like the pileup's nsegments.
+    # samtools depth has no orphan filter, so the orphans (paired reads with no proper pair flag) are counted on their own
+    # and taken off, leaving the reads of pileup_skips
+    return samtools_depth(alignment, contig, start, stop, "-Q", str(min_mapping_quality)) - \
+        samtools_depth(alignment, contig, start, stop, "-Q", str(min_mapping_quality), *ORPHANS_ONLY)
+
+
+def samtools_depth(alignment, contig, start, stop, *options):
+    # depth of every column of [start, stop) of contig from samtools depth -a -J with the extra options
+    depth = np.zeros(stop - start, dtype=np.int64)
+    out = pysam.depth("-a", "-J", *options, "-r", "%s:%d-%d" % (contig, start + 1, stop), alignment.filename.decode())
+    if out:
+        columns = np.array(out.split(), dtype=object).reshape(-1, 3)
+        depth[columns[:, 1].astype(np.int64) - 1 - start] = columns[:, 2].astype(np.int64)
+    return depth
+
+
+def can_truncate(deepest, pileup):
+    # htslib stops adding the reads that start at a column once the reads over the column before and those already
+    # added reach max_depth, they are then missing from every column they cover (under the limit or not). That needs
+    # two neighbouring columns adding up to max_depth, below that the pileup depth can't have lost reads
+    return deepest * 2 >= pileup["max_depth"]
+
+
+def bin_coverage(depth, bin_size=100):
+    # min, mean and max depth of each bin of bin_size columns (the last bin can be shorter), 3 x bins
+    starts = np.arange(0, len(depth), bin_size)
+    if not len(starts):
+        return np.zeros((3, 0))
+    sizes = np.diff(np.append(starts, len(depth)))
+    return np.stack([np.minimum.reduceat(depth, starts), np.add.reduceat(depth, starts) / sizes, np.maximum.reduceat(depth, starts)])
+
+
+def cigar_blocks(reads, offsets=None):
+    # one walk over the cigars of reads (placed at offsets, at 0 without) for the aligned blocks, as arrays of
+    # (read index, reference start, query start, length), and deletions, as (read index, reference start, length,
+    # query position of the next base, query end of the read). Query positions index seq and qual, the bases and
+    # qualities of all the reads joined together
+    block_read, block_ref, block_query, block_len = [], [], [], []
+    del_read, del_ref, del_len, del_next, del_end = [], [], [], [], []
+    seqs, quals = [], []
+    qstart = 0
+    for num, read in enumerate(reads):
+        rpos, qpos = read.reference_start + (0 if offsets is None else offsets[num]), qstart
+        for op, op_len in read.cigartuples:
+            if op in (0, 7, 8):
+                block_read.append(num)
+                block_ref.append(rpos)
+                block_query.append(qpos)
+                block_len.append(op_len)
+                rpos += op_len
+                qpos += op_len
+            elif op == 2:
+                del_read.append(num)
+                del_ref.append(rpos)
+                del_len.append(op_len)
+                del_next.append(qpos)
+                rpos += op_len
+            elif op == 3:
+                rpos += op_len
+            elif op in (1, 4):
+                qpos += op_len
+        seq = read.query_sequence.encode()
+        qstart += len(seq)
+        del_end += [qstart] * (len(del_ref) - len(del_end))
+        seqs.append(seq)
+        qual = read.query_qualities
+        quals.append(b"\xff" * len(seq) if qual is None else qual.tobytes())
+    seq = np.frombuffer(b"".join(seqs), dtype=np.uint8)
+    qual = np.frombuffer(b"".join(quals), dtype=np.uint8)
+    blocks = tuple(np.array(i, dtype=np.int64) for i in (block_read, block_ref, block_query, block_len))
+    deletions = tuple(np.array(i, dtype=np.int64) for i in (del_read, del_ref, del_len, del_next, del_end))
+    return seq, qual, blocks, deletions
+
+
+def kept_deletions(deletions, qual, min_base_quality=13):
+    # as in the pileup a deletion is filtered on the quality of the next base, and left out at the end of a read
+    del_next, del_end = deletions[3], deletions[4]
+    return (del_next < del_end) & (qual[np.minimum(del_next, len(qual) - 1)] >= min_base_quality)
+
+
+def count_batch(batch, length, min_base_quality=13):
+    # flat index (position * len(BASES) + allele) of every base and deletion in a batch of reads that passes min_base_quality
+    # and falls in [0, length) once the reads are placed at their offsets, and the batch index of the read it is from.
+    # batch is a list of (read, offset of its contig, pair) where pair is the batch index of the first read of an overlapping
+    # read pair (the one pileup sees first) or None. The bases of the pairs are adjusted the way pileup does it first:
+    # where the mates agree the first keeps the summed quality, where they disagree the better base keeps 0.8 of its quality
+    # (the first on a tie), the other base gets quality 0.
+    seq, qual, (block_read, block_ref, block_query, block_len), deletions = cigar_blocks([i[0] for i in batch], [i[1] for i in batch])
+    qual = qual.copy()
+    read_pair = np.array([-1 if pair is None else pair for read, offset, pair in batch], dtype=np.int64)
+    read_second = np.array([pair is not None and pair != num for num, (read, offset, pair) in enumerate(batch)], dtype=bool)
+    # one entry per aligned base
+    block = np.repeat(np.arange(len(block_len)), block_len)
+    within = np.arange(len(block)) - np.repeat(np.cumsum(block_len) - block_len, block_len)
+    ref = block_ref[block] + within
+    query = block_query[block] + within
+    pair = read_pair[block_read[block]]
+    second = read_second[block_read[block]]
+    paired = np.flatnonzero(pair >= 0)
+    if len(paired):
+        paired_ref = ref[paired] - ref[paired].min()
+        key = pair[paired] * (paired_ref.max() + 1) + paired_ref
+        order = np.argsort(key, kind="stable")
+        key = key[order]
+        same_column = np.flatnonzero(key[1:] == key[:-1])
+        first, other = paired[order[same_column]], paired[order[same_column + 1]]
+        swap = second[first]
+        first, other = np.where(swap, other, first), np.where(swap, first, other)
+        first, other = query[first], query[other]
+        first_qual, other_qual = qual[first].astype(np.int64), qual[other].astype(np.int64)
+        agree = seq[first] == seq[other]
+        first_better = first_qual >= other_qual
+        qual[first] = np.where(agree, np.minimum(first_qual + other_qual, 200), np.where(first_better, first_qual * 4 // 5, 0))
+        qual[other] = np.where(agree | first_better, 0, other_qual * 4 // 5)
+    keep = (qual[query] >= min_base_quality) & (ref >= 0) & (ref < length)
+    index = [ref[keep] * len(BASES) + _BASE_INDEX[seq[query[keep]]]]
+    index_read = [block_read[block[keep]]]
+    if len(deletions[0]):
+        keep = kept_deletions(deletions, qual, min_base_quality)
+        del_len = deletions[2][keep]
+        within = np.arange(del_len.sum()) - np.repeat(np.cumsum(del_len) - del_len, del_len)
+        deleted = np.repeat(deletions[1][keep], del_len) + within
+        inside = (deleted >= 0) & (deleted < length)
+        index.append(deleted[inside] * len(BASES) + 5)
+        index_read.append(np.repeat(deletions[0][keep], del_len)[inside])
+    return np.concatenate(index), np.concatenate(index_read)
+
+
+_CIGAR_REF_LEN = re.compile(r"(\d+)[MDN=X]")
+
+
+def mate_end(read):
+    # reference end of the mate from its MC tag, taken to be as long as the read itself without one
+    if read.has_tag("MC"):
+        return read.next_reference_start + sum(int(i) for i in _CIGAR_REF_LEN.findall(read.get_tag("MC")))
+    return read.next_reference_start + read.reference_length
+
+
+def count_reads(reads, offsets, length, min_base_quality=13, max_pending=100000, batch_size=5000, min_mapping_quality=0, weights=None):
+    # allele counts and covered columns of [0, length) from reads in any order, each read is placed at the offset of its contig
+    # (offsets is keyed by reference id, reads on other contigs are skipped). Memory is bounded by length and max_pending
+    # reads waiting for an overlapping mate, reads whose mate doesn't turn up in time are counted without the overlap adjustment.
+    # Base qualities are filtered in count_batch, a batch at a time.
+    # Returns the counts, covered, the number of reads and, with weights (by read name), the counts with each read weighted
+    counts = np.zeros(length * len(BASES), dtype=np.int64)
+    weighted = None if weights is None else np.zeros(length * len(BASES))
+    coverage = np.zeros(length + 1, dtype=np.int64)
+    pending = collections.OrderedDict()
+    batch = []
+    num_reads = 0
+
+    def flush():
+        index, index_read = count_batch(batch, length, min_base_quality)
+        counts[:] += np.bincount(index, minlength=len(counts))
+        if weighted is not None:
+            read_weights = np.array([weights[read.query_name] for read, offset, pair in batch], dtype=float)
+            weighted[:] += np.bincount(index, weights=read_weights[index_read], minlength=len(weighted))
+        starts = np.clip([offset + read.reference_start for read, offset, pair in batch], 0, length)
+        ends = np.clip([offset + read.reference_end for read, offset, pair in batch], 0, length)
+        coverage[:] += np.bincount(starts, minlength=len(coverage)) - np.bincount(ends, minlength=len(coverage))
+        batch.clear()
+
+    for read in reads:
+        if pileup_skips(read, min_mapping_quality) or read.reference_id not in offsets or read.query_sequence is None:
+            continue
+        num_reads += 1
+        offset = offsets[read.reference_id]
+        # only a primary record of the other mate (read 1 against read 2) takes a read out of pending, in bwa style name
+        # grouped output a supplementary alignment of read 1 comes between the two mates
+        mate = pending.get(read.query_name) if not read.flag & 2048 else None
+        if mate is not None and mate[1] == offset and (mate[0].flag ^ read.flag) & 192:
+            del pending[read.query_name]
+            # pileup sees the leftmost mate first
+            if read.reference_start < mate[0].reference_start:
+                batch += [(read, offset, len(batch)), (mate[0], offset, len(batch))]
+            else:
+                batch += [(mate[0], offset, len(batch)), (read, offset, len(batch))]
+        elif read.flag & 2 and not read.flag & (8 | 2048) and read.query_name not in pending and \
+                read.next_reference_id == read.reference_id and read.next_reference_start < read.reference_end and \
+                mate_end(read) > read.reference_start:
+            # proper pair overlapping a mate that hasn't turned up yet, on either side (in name grouped output
+            # the rightmost mate often comes first)
+            pending[read.query_name] = (read, offset)
+            if len(pending) > max_pending:
+                batch.append((*pending.popitem(last=False)[1], None))
+        else:
+            batch.append((read, offset, None))
+        if len(batch) >= batch_size:
+            flush()
+    batch += [(read, offset, None) for read, offset in pending.values()]
+    if batch:
+        flush()
+    if weighted is not None:
+        weighted = weighted.reshape(length, len(BASES))
+    return counts.reshape(length, len(BASES)), np.cumsum(coverage[:-1]) > 0, num_reads, weighted
+
+
+def count_stream(alignment, contigs, min_base_quality=13, stats=None, min_mapping_quality=0):
+    # allele counts and covered columns of every contig from a single pass over the reads in file order (e.g. unsorted from stdin),
+    # as (counts, covered, saturated, kept, depth) like load_counts. Streamed counts have no depth limit and every read is counted
+    offsets = {}
+    length = 0
+    for contig in contigs:
+        offsets[alignment.get_tid(contig)] = length
+        length += alignment.get_reference_length(contig)
+    counts, covered, num_reads = count_reads(alignment.fetch(until_eof=True), offsets, length, min_base_quality,
+                                             min_mapping_quality=min_mapping_quality)[:3]
+    if stats is not None:
+        stats.add("stream_reads", num_reads)
+    genome_counts = {}
+    for contig in contigs:
+        start = offsets[alignment.get_tid(contig)]
+        stop = start + alignment.get_reference_length(contig)
+        depth = counts[start:stop].sum(axis=1)
+        genome_counts[contig] = (counts[start:stop], covered[start:stop], np.zeros(stop - start, dtype=bool), depth, depth)
+    return genome_counts
+
+
+def sample_fraction(names, seed=0):
+    # a number in [0, 1) for each read name that only depends on the name and seed, so mates share it
+    x = np.array([zlib.crc32(name.encode()) for name in names], dtype=np.uint64) + (np.uint64(seed) << np.uint64(32))
+    # splitmix64 finaliser
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    x = x ^ (x >> np.uint64(31))
+    return (x >> np.uint64(11)) / float(1 << 53)
+
+
+def span_max(depth, starts, ends):
+    # maximum of depth over each span [starts, ends) clipped to it, 0 for empty spans
+    starts, ends = np.clip(starts, 0, len(depth)), np.clip(ends, 0, len(depth))
+    maxima = np.maximum.reduceat(np.append(depth, 0), np.column_stack([starts, ends]).ravel())[::2]
+    return np.where(ends > starts, maxima, 0)
+
+
+def sample_window(samfile, start, stop, contig, sample_depth, seed=0, pileup=None, depth=None, batch_size=5000):
+    # counts, covered and the number of fragments counted at each column of [start, stop) from a seeded sample of about
+    # sample_depth fragments (read pairs) per column, with the counts scaled to the full depth. depth is fragment_depth of
+    # the window, looked up when it's None. A fragment is kept with probability sample_depth / depth of the deepest column
+    # of its template (from the template length, its own span for a read that isn't in a proper pair), which both mates
+    # see the same, so reads are picked as they are fetched and only the kept ones are counted. The allele fractions are
+    # weighted by one over that probability. None when no column is deeper than sample_depth
+    if pileup is None:
+        pileup = DEFAULT_PILEUP
+    if depth is None:
+        depth = fragment_depth(samfile, contig, start, stop, pileup["min_mapping_quality"], pileup["min_base_quality"])
+    if depth.max(initial=0) <= sample_depth:
+        return None
+    weights = {}
+
+    def choose(batch):
+        starts, ends, names = [], [], []
+        for read in batch:
+            if read.flag & 2 and read.template_length:
+                starts.append(min(read.reference_start, read.next_reference_start))
+                ends.append(starts[-1] + abs(read.template_length))
+            else:
+                starts.append(read.reference_start)
+                ends.append(read.reference_end)
+            names.append(read.query_name)
+        deepest = np.maximum(span_max(depth, np.array(starts) - start, np.array(ends) - start), 1)
+        keep = sample_fraction(names, seed) * deepest < sample_depth
+        for read, name, i, j in zip(batch, names, deepest.tolist(), keep.tolist()):
+            if j:
+                weights[name] = max(i / sample_depth, 1.0)
+                yield read
+
+    def kept():
+        batch = []
+        for read in samfile.fetch(contig, start, stop):
+            if pileup_skips(read, pileup["min_mapping_quality"]):
+                continue
+            batch.append(read)
+            if len(batch) >= batch_size:
+                yield from choose(batch)
+                batch = []
+        if batch:
+            yield from choose(batch)
+
+    length = stop - start
+    counts, covered, num_reads, weighted = count_reads(kept(), {samfile.get_tid(contig): -start}, length, pileup["min_base_quality"],
+                                                       weights=weights)
+    total = weighted.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scale = np.where(total > 0, depth / total, 0)
+    return np.rint(weighted * scale[:, None]).astype(np.int64), covered | (depth > 0), counts.sum(axis=1)
+
+
+def proportion_intervals(proportion, n, z=1.96):
+    # Wilson score intervals (lower, upper) of each proportion, from the number of reads n it was estimated from
+    n = np.asarray(n, dtype=float)[:, None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        centre = (proportion + z * z / (2 * n)) / (1 + z * z / n)
+        half = z * np.sqrt(proportion * (1 - proportion) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+    return np.clip(np.nan_to_num(np.stack([centre - half, centre + half], axis=2)), 0, 1)
+
+
+# allele code of a read at a site it doesn't cover (or covers with a low quality base)
+NO_ALLELE = 255
+
+
+def read_signatures(reads, sites, min_base_quality=13):
+    # allele (column in BASES) of each read at each of the sorted 0-based site positions, reads x sites
+    signatures = np.full((len(reads), len(sites)), NO_ALLELE, dtype=np.uint8)
+    seq, qual, (block_read, block_ref, block_query, block_len), deletions = cigar_blocks(reads)
+    if not len(block_ref):
+        return signatures
+    # only the sites inside each block are expanded, not every aligned base
+    lo = np.searchsorted(sites, block_ref)
+    hits = np.searchsorted(sites, block_ref + block_len) - lo
+    site = np.repeat(lo, hits) + np.arange(hits.sum()) - np.repeat(np.cumsum(hits) - hits, hits)
+    read_index = np.repeat(block_read, hits)
+    query = np.repeat(block_query - block_ref, hits) + sites[site]
+    keep = qual[query] >= min_base_quality
+    signatures[read_index[keep], site[keep]] = _BASE_INDEX[seq[query[keep]]]
+    if len(deletions[0]):
+        keep = kept_deletions(deletions, qual, min_base_quality)
+        del_read, del_ref, del_len = deletions[0][keep], deletions[1][keep], deletions[2][keep]
+        lo = np.searchsorted(sites, del_ref)
+        hits = np.searchsorted(sites, del_ref + del_len) - lo
+        site = np.repeat(lo, hits) + np.arange(hits.sum()) - np.repeat(np.cumsum(hits) - hits, hits)
+        signatures[np.repeat(del_read, hits), site] = 5
+    return signatures
+
+
+def link_region(samfile, contig, sites, min_base_quality=13, batch_size=5000, min_mapping_quality=0):
+    # allele signatures of the fragments (read pairs) over the sorted 0-based site positions from one fetch, with the
+    # number of fragments that have each, only fragments with an allele at two or more sites are kept.
+    # Reads waiting for their mate are kept as signatures rather than reads, and a read whose mate hasn't turned up by
+    # the mate's start (filtered or unmapped) is counted on its own
+    sites = np.asarray(sites, dtype=np.int64)
+    fragments = collections.Counter()
+    pending = {}
+    mate_starts = []
+    batch = []
+    stop = int(sites[-1]) + 1
+
+    def add(signature):
+        if np.count_nonzero(signature != NO_ALLELE) > 1:
+            fragments[signature.tobytes()] += 1
+
+    def flush():
+        for read, signature in zip(batch, read_signatures(batch, sites, min_base_quality)):
+            while mate_starts and mate_starts[0][0] < read.reference_start:
+                name = heapq.heappop(mate_starts)[1]
+                if name in pending:
+                    add(pending.pop(name))
+            mate = pending.pop(read.query_name, None)
+            if mate is not None:
+                # where the mates disagree the site is left out
+                add(np.where(mate == NO_ALLELE, signature, np.where((signature == NO_ALLELE) | (signature == mate), mate, NO_ALLELE)))
+            elif read.flag & 2 and not read.flag & 8 and read.next_reference_id == read.reference_id and \
+                    read.reference_start <= read.next_reference_start < stop:
+                pending[read.query_name] = signature
+                heapq.heappush(mate_starts, (read.next_reference_start, read.query_name))
+            else:
+                add(signature)
+        batch.clear()
+
+    for read in samfile.fetch(contig, int(sites[0]), stop):
+        # supplementary alignments would be taken for the mate
+        if pileup_skips(read, min_mapping_quality) or read.flag & 2048 or read.query_sequence is None:
+            continue
+        batch.append(read)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    for signature in pending.values():
+        add(signature)
+    if not fragments:
+        return np.zeros((0, len(sites)), dtype=np.uint8), np.zeros(0, dtype=np.int64)
+    signatures = np.frombuffer(b"".join(fragments), dtype=np.uint8).reshape(len(fragments), len(sites))
+    return signatures, np.array(list(fragments.values()), dtype=np.int64)
+
+
+def link_sites(samfile, positions, site_contigs, link_distance=500, min_base_quality=13, stats=None, min_mapping_quality=0):
+    # allele co-occurrence counts (len(BASES) x len(BASES), fragments with both) of every pair of sites no more than
+    # link_distance apart, keyed by (contig, position, position) with 0-based positions, one fetch per group of nearby sites
+    tables = {}
+    by_contig = defaultdict(set)
+    for pos, contig in zip(positions, site_contigs):
+        by_contig[contig].add(pos)
+    for contig, contig_positions in by_contig.items():
+        for start, stop in site_regions(contig_positions, link_distance):
+            sites = np.array(sorted(pos for pos in contig_positions if start <= pos <= stop), dtype=np.int64)
+            if len(sites) < 2:
+                continue
+            signatures, counts = link_region(samfile, contig, sites, min_base_quality, min_mapping_quality=min_mapping_quality)
+            if stats is not None:
+                stats.add("linked_fragments", counts.sum())
+            for i in range(len(sites)):
+                for j in range(i + 1, np.searchsorted(sites, sites[i] + link_distance, side="right")):
+                    both = (signatures[:, i] != NO_ALLELE) & (signatures[:, j] != NO_ALLELE)
+                    table = np.bincount(signatures[both, i].astype(np.intp) * len(BASES) + signatures[both, j], weights=counts[both],
+                                        minlength=len(BASES) * len(BASES))
+                    tables[(contig, int(sites[i]), int(sites[j]))] = table.astype(np.int64).reshape(len(BASES), len(BASES))
+    return tables
+
+
+def linkage_stats(table, allele_i, allele_j):
+    # r squared and D of allele_i at the first site with allele_j at the second (each against all other alleles),
+    # D > 0 when they are on the same fragments more often than by chance. None without variation at either site
+    n = table.sum()
+    if n == 0:
+        return None
+    p = table[allele_i].sum() / n
+    q = table[:, allele_j].sum() / n
+    if p in (0, 1) or q in (0, 1):
+        return None
+    d = table[allele_i, allele_j] / n - p * q
+    return d * d / (p * (1 - p) * q * (1 - q)), d
+
+
+# bump when the way counts are made changes so that old cache files are ignored
+CACHE_VERSION = 8
+
+
+def find_index(bam_file):
+    for index_file in (bam_file + ".bai", bam_file + ".csi", os.path.splitext(bam_file)[0] + ".bai"):
+        if os.path.exists(index_file):
+            return index_file
+    return None
+
+
+def cache_key(bam_file, contig, sample_depth=None, seed=0, pileup=None):
+    # cache is invalidated when the bam, its index or the counting parameters change
+    key = {"version": CACHE_VERSION, "contig": contig}
+    if sample_depth is not None:
+        key["sample"] = [sample_depth, seed]
+    if pileup is not None and pileup != DEFAULT_PILEUP:
+        key["pileup"] = pileup
+    for name, path in (("bam", bam_file), ("index", find_index(bam_file))):
+        if path is None:
+            key[name] = None
+        else:
+            stat = os.stat(path)
+            key[name] = [os.path.realpath(path), stat.st_size, stat.st_mtime_ns]
+    return json.dumps(key, sort_keys=True)
+
+
+def cache_path(cache_dir, bam_file, contig, sample_depth=None, seed=0, pileup=None):
+    name = os.path.realpath(bam_file) + "\t" + contig
+    if sample_depth is not None:
+        name += "\t%d\t%d" % (sample_depth, seed)
+    if pileup is not None and pileup != DEFAULT_PILEUP:
+        name += "\t" + json.dumps(pileup, sort_keys=True)
+    digest = hashlib.sha1(name.encode()).hexdigest()
+    return os.path.join(cache_dir, digest + ".npz")
+
+
+def read_cache(cache_dir, bam_file, contig, sample_depth=None, seed=0, pileup=None):
+    path = cache_path(cache_dir, bam_file, contig, sample_depth, seed, pileup)
+    try:
+        with np.load(path) as cache:
+            if str(cache["key"]) != cache_key(bam_file, contig, sample_depth, seed, pileup):
+                return None
+            counts, covered, saturated, kept, depth = cache["counts"], cache["covered"], cache["saturated"], cache["kept"], cache["depth"]
+    except (OSError, KeyError, ValueError):
+        return None
+    # mark as recently used for eviction
+    os.utime(path)
+    return counts, covered, saturated, kept, depth
+
+
+def write_cache(cache_dir, bam_file, contig, counts, covered, cache_size=None, sample_depth=None, seed=0, saturated=None, pileup=None,
+                kept=None, depth=None):
+    os.makedirs(cache_dir, exist_ok=True)
+    if saturated is None:
+        saturated = np.zeros(len(covered), dtype=bool)
+    if kept is None:
+        kept = counts.sum(axis=1)
+    if depth is None:
+        depth = counts.sum(axis=1)
+    path = cache_path(cache_dir, bam_file, contig, sample_depth, seed, pileup)
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "wb") as out:
+        np.savez_compressed(out, key=np.array(cache_key(bam_file, contig, sample_depth, seed, pileup)), counts=counts, covered=covered,
+                            saturated=saturated, kept=kept, depth=depth)
+    os.replace(tmp_path, path)
+    if cache_size is not None:
+        evict_cache(cache_dir, cache_size, keep=path)
+
+
+def evict_cache(cache_dir, cache_size, keep=None):
+    # remove least recently used cache files until the directory is under cache_size bytes
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if not name.endswith(".npz"):
+            continue
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    total = sum(i[1] for i in entries)
+    for mtime, size, path in entries:
+        if total <= cache_size:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def load_counts(bam_file, cache_dir, contig=DEFAULT_CONTIG, processes=1, cache_size=None, stats=None, sample_depth=None, seed=0,
+                pileup=None):
+    # genome wide counts, covered and saturated columns, the number of reads each column was counted from and the depth
+    # of each column (genome_coverage, which doesn't change with max_depth or sampling) for bam_file, from the cache if it
+    # is still valid
+    if pileup is None:
+        pileup = DEFAULT_PILEUP
+    cached = read_cache(cache_dir, bam_file, contig, sample_depth, seed, pileup)
+    if cached is not None:
+        if stats is not None:
+            stats.add("cache_hits", 1)
+        return cached
+    with pysam.AlignmentFile(bam_file, "rb") as alignment:
+        saturated = np.zeros(alignment.get_reference_length(contig), dtype=bool)
+        kept = np.zeros(alignment.get_reference_length(contig), dtype=np.int64)
+        depth = genome_coverage(alignment, contig, pileup["min_mapping_quality"], pileup["min_base_quality"])
+        counts, covered = count_genome(alignment, contig, processes, sample_depth=sample_depth, seed=seed, pileup=pileup,
+                                       saturated=saturated, kept=kept, depth=depth)
+    if stats is not None:
+        stats.add("cache_misses", 1)
+        stats.add("minor_columns_visited", covered.sum())
+        stats.add("minor_reads_inspected", kept.sum())
+        stats.add("minor_columns_saturated", saturated.sum())
+    write_cache(cache_dir, bam_file, contig, counts, covered, cache_size, sample_depth, seed, saturated, pileup, kept, depth)
+    return counts, covered, saturated, kept, depth
+
+
+def _reset_peak_rss():
+    # writing 5 to clear_refs resets the peak resident set size (VmHWM) of the process on linux,
+    # returns False where that isn't possible
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb(reset):
+    # peak resident set size since the last reset, or over the whole run if it couldn't be reset
+    if reset:
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class RunStats:
+    # wall time and peak memory of each stage of a run plus counters of the work done,
+    # stages marked hot are also run under cProfile when profiling is on.
+    # ru_maxrss never goes down, so the peak of each stage is read from VmHWM after resetting it where /proc allows.
+    # With measure off (when nobody asked for stats) stages do nothing, so the peak of the process isn't reset under
+    # a program using the library
+
+    def __init__(self, profile=False, measure=True):
+        self.stages = []
+        self.counters = defaultdict(int)
+        self.profiler = cProfile.Profile() if profile else None
+        self.measure = measure or profile
+        self.start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name, hot=False):
+        if not self.measure:
+            yield
+            return
+        profile = hot and self.profiler is not None
+        reset = _reset_peak_rss()
+        start = time.perf_counter()
+        if profile:
+            self.profiler.enable()
+        try:
+            yield
+        finally:
+            if profile:
+                self.profiler.disable()
+            self.stages.append({"stage": name, "seconds": time.perf_counter() - start,
+                                "max_rss_mb": _peak_rss_mb(reset), "max_rss_per_stage": reset,
+                                "children_max_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024})
+
+    def add(self, name, value):
+        self.counters[name] += int(value)
+
+    def write_json(self, filename, **info):
+        out = dict(info)
+        out["total_seconds"] = time.perf_counter() - self.start
+        out["stages"] = self.stages
+        out["counters"] = dict(self.counters)
+        with open(filename, "w") as f:
+            json.dump(out, f, indent=1)
+
+    def write_profile(self, filename):
+        self.profiler.dump_stats(filename)
+
+
+@functools.lru_cache(maxsize=8)
+def open_reference(ref):
+    # indexed fasta, the .fai is made next to the fasta if it doesn't exist
+    return pysam.FastaFile(ref)
+
+
+def detect_contigs(alignment, reference, contigs=None):
+    # contigs to look at: those given, otherwise every contig in both the bam header and the reference
+    if contigs is None:
+        contigs = [i for i in alignment.references if i in reference.references]
+        if not contigs:
+            raise ValueError("no contig of %s is in the reference (%s)" % (alignment.filename.decode(), ", ".join(reference.references)))
+    for contig in contigs:
+        if contig not in alignment.references:
+            raise ValueError("contig %s is not in %s" % (contig, alignment.filename.decode()))
+        if contig not in reference.references:
+            raise ValueError("contig %s is not in the reference" % contig)
+    return list(contigs)
+
+
+def table_contig(contigs, given=False):
+    # contig the variant table sites are placed on: the SARS-CoV-2 one among contigs, otherwise the first contig given
+    # with -C or the only one there is
+    for contig in GENES:
+        if contig in contigs:
+            return contig
+    if given or len(contigs) == 1:
+        return contigs[0]
+    raise ValueError("can't tell which of %s the variant table sites are on, give it first with -C" % ", ".join(contigs))
+
+
+def genome_sites(sites, genome_counts, reference, all_minor, all_minor_fraction, all_minor_cov, stats):
+    # sites, their counts, whether they are saturated and the reads they were counted from, from per contig
+    # (counts, covered, saturated, kept, depth) of the whole genome (from load_counts or count_stream)
+    with stats.stage("minor_scan"):
+        if all_minor:
+            minor = []
+            for contig in genome_counts:
+                minor += select_minor(sites, genome_counts[contig][0], genome_counts[contig][1], reference, all_minor_fraction,
+                                      all_minor_cov, contig)
+            sites = minor
+    with stats.stage("site_counts"):
+        counts = np.zeros((len(sites), len(BASES)), dtype=np.int64)
+        saturated = np.zeros(len(sites), dtype=bool)
+        kept = np.zeros(len(sites), dtype=np.int64)
+        for num, i in enumerate(sites):
+            contig_counts, covered, contig_saturated, contig_kept, depth = genome_counts[i[4]]
+            if 0 < i[1] <= len(contig_counts):
+                counts[num] = contig_counts[i[1]-1]
+                saturated[num] = contig_saturated[i[1]-1]
+                kept[num] = contig_kept[i[1]-1]
+    return sites, counts, saturated, kept
+
+
+def compute_sample(bam_file, sites, reference, all_minor, all_minor_fraction, all_minor_cov, threads=1, cache_dir=None, cache_size=None,
+                   stats=None, contigs=None, alignment=None, stream=False, sample_depth=None, seed=0, coverage_bin=None, pileup=None):
+    # counts at the sites to report, sites from the variant table are placed on the contig from table_contig.
+    # alignment can be an already open AlignmentFile for bam_file, it is left open.
+    # With stream the reads are counted in one pass in file order, bam_file doesn't need to be sorted or indexed ("-" is stdin).
+    # With sample_depth (not with stream) the genome scan (-m or the cache) counts columns deeper than that from a seeded
+    # sample of the reads, sites counted that way are marked sampled.
+    # With coverage_bin the depth of every contig is binned, from samtools depth with the same filters (kept in the cache with
+    # cache_dir, from the counts with stream).
+    # pileup is from pileup_args, sites where the pileup hit its max_depth are marked saturated
+    if pileup is None:
+        pileup = DEFAULT_PILEUP
+    if sample_depth is not None and sample_depth < 1:
+        raise ValueError("sample_depth must be at least 1, not %d" % sample_depth)
+    if stream:
+        sample_depth = None
+    if stats is None:
+        stats = RunStats(measure=False)
+    if isinstance(reference, str):
+        reference = open_reference(reference)
+    if alignment is None:
+        handle = pysam.AlignmentFile(bam_file, "r" if stream else "rb")
+    else:
+        handle = contextlib.nullcontext(alignment)
+    genome_counts = None
+    coverage = None if coverage_bin is None else {}
+    with handle as alignment:
+        given = contigs is not None
+        contigs = detect_contigs(alignment, reference, contigs)
+        contig_lengths = [(i, alignment.get_reference_length(i)) for i in contigs]
+        on_contig = table_contig(contigs, given)
+        sites = [i[:4] + [on_contig] for i in sites]
+        past = [i[1] for i in sites if i[1] > alignment.get_reference_length(on_contig)]
+        if past:
+            raise ValueError("%d variant table site(s) are past the end of %s (%d bp), from position %d"
+                             % (len(past), on_contig, alignment.get_reference_length(on_contig), min(past)))
+        if stream:
+            with stats.stage("stream_counts", hot=True):
+                genome_counts = count_stream(alignment, contigs, pileup["min_base_quality"], stats, pileup["min_mapping_quality"])
+        elif cache_dir is None:
+            with stats.stage("minor_scan", hot=True):
+                if all_minor:
+                    sites = get_minor(sites, alignment, reference, all_minor_fraction, all_minor_cov, threads, stats, contigs, sample_depth,
+                                      seed, pileup)
+            with stats.stage("site_counts", hot=True):
+                saturated, sampled = np.zeros(len(sites), dtype=bool), np.zeros(len(sites), dtype=bool)
+                counts = count_alleles(alignment, [i[1]-1 for i in sites], [i[4] for i in sites], stats, pileup, saturated)
+                kept = counts.sum(axis=1)
+        if coverage is not None and not stream and cache_dir is None:
+            with stats.stage("coverage", hot=True):
+                for contig in contigs:
+                    coverage[contig] = genome_coverage(alignment, contig, pileup["min_mapping_quality"], pileup["min_base_quality"])
+    if genome_counts is None and cache_dir is not None:
+        with stats.stage("load_counts", hot=True):
+            genome_counts = {}
+            for contig in contigs:
+                genome_counts[contig] = load_counts(bam_file, cache_dir, contig, threads, cache_size, stats, sample_depth, seed, pileup)
+    if genome_counts is not None:
+        # kept is the number of reads the proportions were estimated from, fewer than the depth at sampled columns
+        sites, counts, saturated, kept = genome_sites(sites, genome_counts, reference, all_minor, all_minor_fraction, all_minor_cov, stats)
+        sampled = np.full(len(sites), sample_depth is not None)
+        if coverage is not None:
+            for contig in contigs:
+                coverage[contig] = genome_counts[contig][4]
+    if coverage is not None:
+        coverage = {contig: bin_coverage(depth, coverage_bin) for contig, depth in coverage.items()}
+    stats.add("sites", len(sites))
+    proportion = variant_proportions(counts, sites)
+    return {"sites": sites, "counts": counts, "proportion": proportion, "contig_lengths": contig_lengths, "table_contig": on_contig,
+            "sample_depth": sample_depth,
+            "intervals": proportion_intervals(proportion, kept), "coverage": coverage,
+            "coverage_bin": coverage_bin, "saturated": saturated, "sampled": sampled}
+
+
+def add_mixture(result, lineages, lineage_alleles, reference):
+    # lineage_alleles has the allele of each lineage at the variant table sites (by position, on the table contig),
+    # other sites (from -m) get the reference base for every lineage and are left out of the estimate
+    sites = result["sites"]
+    ref_bases = [reference.fetch(i[4], i[1]-1, i[1]).upper() for i in sites]
+    in_table = np.array([i[4] == result["table_contig"] and i[1] in lineage_alleles for i in sites], dtype=bool)
+    alleles = [lineage_alleles[i[1]] if table else [base] * len(lineages) for i, base, table in zip(sites, ref_bases, in_table)]
+    codes = allele_codes(alleles, len(lineages))
+    ref_codes = _BASE_INDEX[np.array([ord(i[:1] or "N") for i in ref_bases], dtype=np.intp)]
+    mixture, explained = estimate_mixture(result["counts"][in_table], codes[in_table])
+    result.update({"lineages": list(lineages), "lineage_alleles": alleles, "frequencies": lineage_frequencies(result["counts"], codes),
+                   "defining": codes != ref_codes[:, None], "mixture": mixture, "explained": explained})
+    return result
+
+
+def add_linkage(result, bam_file, link_distance=500, min_fragments=10, alignment=None, stats=None, pileup=None):
+    # linkage of each pair of sites no more than link_distance apart that at least min_fragments fragments cover.
+    # The allele followed at a site is variant 1's where the variants differ, otherwise the most common one
+    if pileup is None:
+        pileup = DEFAULT_PILEUP
+    sites = result["sites"]
+    if alignment is None:
+        handle = pysam.AlignmentFile(bam_file, "rb")
+    else:
+        handle = contextlib.nullcontext(alignment)
+    with handle as alignment:
+        tables = link_sites(alignment, [i[1]-1 for i in sites], [i[4] for i in sites], link_distance, pileup["min_base_quality"], stats,
+                            pileup["min_mapping_quality"])
+    code_a = _BASE_INDEX[np.array([ord(i[2][:1] or "N") for i in sites], dtype=np.intp)]
+    code_b = _BASE_INDEX[np.array([ord(i[3][:1] or "N") for i in sites], dtype=np.intp)]
+    alleles = np.where(code_a != code_b, code_a, result["counts"].argmax(axis=1)) if len(sites) else code_a
+    rows = defaultdict(list)
+    for num, i in enumerate(sites):
+        rows[(i[4], i[1]-1)].append(num)
+    linkage = []
+    for (contig, pos_i, pos_j), table in tables.items():
+        if table.sum() < min_fragments:
+            continue
+        for i in rows[(contig, pos_i)]:
+            for j in rows[(contig, pos_j)]:
+                linked = linkage_stats(table, alleles[i], alleles[j])
+                if linked is not None:
+                    linkage.append((min(i, j), max(i, j)) + linked)
+    result["linkage"] = linkage
+    result["linkage_tables"] = tables
+    return result
+
+
+def render_sample(result, reference, variantA, variantB, panel3):
+    # reference is only used for panel 3 and not at all for results that have their reference bases (from read_results)
+    sites = result["sites"]
+    if panel3 and "ref_bases" in result:
+        ref_bases = result["ref_bases"]
+    elif panel3:
+        ref_bases = [reference.fetch(i[4], i[1]-1, i[1]).upper() for i in sites]
+    else:
+        ref_bases = None
+    # the intervals are drawn when the counts come from a sample of the reads
+    intervals = result["intervals"] if result.get("sample_depth") is not None else None
+    return build_svg([i[1] for i in sites], result["proportion"], result["counts"], [i[0] for i in sites], variantA, variantB,
+                     ref_bases, panel3, [i[4] for i in sites], result["contig_lengths"], intervals, result.get("lineages"),
+                     result.get("frequencies"), result.get("defining"), result.get("mixture"), result.get("linkage"), result.get("coverage"),
+                     result.get("coverage_bin"))
+
+
+def run_sample(bam_file, output_file, sites, reference, variantA, variantB, all_minor, all_minor_fraction, all_minor_cov, panel3, threads=1,
+               cache_dir=None, cache_size=None, stats=None, contigs=None, stream=False, sample_depth=None, seed=0, lineages=None,
+               lineage_alleles=None, link_distance=None, coverage_bin=None, results_file=None, pileup=None):
+    # with lineages (and their alleles from get_lineage_sites) the proportion of each lineage in the sample is estimated,
+    # with link_distance the linkage panel is drawn for sites up to that far apart.
+    # The results are written to results_file (see write_results), the svg is only drawn when output_file isn't None
+    if stats is None:
+        stats = RunStats(measure=False)
+    if isinstance(reference, str):
+        reference = open_reference(reference)
+    result = compute_sample(bam_file, sites, reference, all_minor, all_minor_fraction, all_minor_cov, threads, cache_dir, cache_size, stats,
+                            contigs, stream=stream, sample_depth=sample_depth, seed=seed, coverage_bin=coverage_bin, pileup=pileup)
+    if lineages is not None:
+        with stats.stage("mixture"):
+            add_mixture(result, lineages, lineage_alleles, reference)
+    if link_distance is not None:
+        with stats.stage("linkage", hot=True):
+            add_linkage(result, bam_file, link_distance, stats=stats, pileup=pileup)
+    if results_file is not None:
+        with stats.stage("write_results"):
+            result["ref_bases"] = [reference.fetch(i[4], i[1]-1, i[1]).upper() for i in result["sites"]]
+            write_results(results_file, result, variantA, variantB)
+    if output_file is not None:
+        if not result["sites"]:
+            raise ValueError("no sites of %s to draw (none are covered by reads passing the filters)" % bam_file)
+        with stats.stage("draw_output"):
+            svg = render_sample(result, reference, variantA, variantB, panel3)
+            svg_bytes = svg.writesvg(output_file)
+        stats.add("svg_elements", svg.element_count())
+        stats.add("svg_bytes", svg_bytes)
+    return result
+
+
+def write_results(results_file, result, variantA, variantB):
+    # a .json results file has everything needed to draw the svg again (see read_results),
+    # anything else gets a tsv with a line of counts and proportions per site
+    if results_file.endswith(".json"):
+        out = result_json(result)
+        out["variant_1"], out["variant_2"] = variantA, variantB
+        with open(results_file, "w") as f:
+            json.dump(out, f, separators=(",", ":"))
+        return
+    columns = ["contig", "position", "name", "variant_1", "variant_2", "ref_base", "depth"] + list(BASES) + \
+              ["proportion_variant_1", "proportion_variant_2", "proportion_both", "proportion_other", "lower_variant_1", "upper_variant_1",
+               "saturated"]
+    lineages = result.get("lineages", [])
+    columns += ["frequency_" + i for i in lineages]
+    depths = result["counts"].sum(axis=1)
+    with open(results_file, "w") as out:
+        out.write("\t".join(columns) + "\n")
+        for num, i in enumerate(result["sites"]):
+            line = [i[4], str(i[1]), i[0], i[2], i[3], result["ref_bases"][num], str(depths[num])]
+            line += [str(j) for j in result["counts"][num]]
+            line += ["%.4f" % j for j in result["proportion"][num]] + ["%.4f" % j for j in result["intervals"][num][0]]
+            line.append(str(int(result["saturated"][num])))
+            if lineages:
+                line += ["%.4f" % j for j in result["frequencies"][num]]
+            out.write("\t".join(line) + "\n")
+
+
+def read_results(results_file):
+    # result, variant 1 and variant 2 from a .json results file written by write_results, ready for render_sample
+    if not results_file.endswith(".json"):
+        raise ValueError("%s is not a .json results file" % results_file)
+    with open(results_file) as f:
+        data = json.load(f)
+    sites = [[i["name"], i["position"], i["variant_1"], i["variant_2"], i["contig"]] for i in data["sites"]]
+    counts = np.array([[i["counts"][j] for j in BASES] for i in data["sites"]], dtype=np.int64).reshape(len(sites), len(BASES))
+    proportion = variant_proportions(counts, sites)
+    sampled = np.array([i.get("sampled", True) for i in data["sites"]], dtype=bool)
+    # the intervals are kept as written, they depend on how many reads were sampled at each site
+    intervals = np.array([[i["interval"][j] for j in ("variant_1", "variant_2", "both", "other")] for i in data["sites"]],
+                         dtype=float).reshape(len(sites), 4, 2)
+    result = {"sites": sites, "counts": counts, "proportion": proportion, "sample_depth": data["sample_depth"],
+              "intervals": intervals, "sampled": sampled,
+              "contig_lengths": [(i["name"], i["length"]) for i in data["contigs"]], "ref_bases": [i["ref_base"] for i in data["sites"]],
+              "saturated": np.array([i.get("saturated", False) for i in data["sites"]], dtype=bool)}
+    if "lineages" in data:
+        lineages = [i["name"] for i in data["lineages"]]
+        codes = allele_codes([i["lineage_alleles"] for i in data["sites"]], len(lineages))
+        ref_codes = _BASE_INDEX[np.array([ord(i[:1] or "N") for i in result["ref_bases"]], dtype=np.intp)]
+        result.update({"lineages": lineages, "lineage_alleles": [i["lineage_alleles"] for i in data["sites"]],
+                       "frequencies": lineage_frequencies(counts, codes), "defining": codes != ref_codes[:, None],
+                       "mixture": np.array([i["proportion"] for i in data["lineages"]]), "explained": data["explained"]})
+    if "linkage" in data:
+        result["linkage"] = [(i["site_1"], i["site_2"], i["r2"], i["d"]) for i in data["linkage"]]
+    if "coverage" in data:
+        result["coverage_bin"] = data["coverage"]["bin_size"]
+        result["coverage"] = {contig: np.array([i["min"], i["mean"], i["max"]]) for contig, i in data["coverage"]["contigs"].items()}
+    return result, data["variant_1"], data["variant_2"]
+
+
+def render_results(results_file, output_file, panel3):
+    # draw the svg from a results file alone, without the bam file or the reference
+    result, variantA, variantB = read_results(results_file)
+    svg = render_sample(result, None, variantA, variantB, panel3)
+    return svg.element_count(), svg.writesvg(output_file)
+
+
+def _batch_worker(sample, cohort=False, results_dir=None, **kwargs):
+    # errors are reported per sample so that one bad BAM doesn't stop the batch.
+    # With cohort the sites, variant 1 allele fraction and depth of the sample are returned with its summary line
+    # (no sites for a failed sample, which keeps its row blank), with results_dir the results go to a .json file named after the svg
+    bam_file, output_file = sample
+    start = time.time()
+    if results_dir is not None:
+        kwargs["results_file"] = os.path.join(results_dir, os.path.splitext(os.path.basename(output_file))[0] + ".json")
+    try:
+        result = run_sample(bam_file, output_file, **kwargs)
+    except Exception as e:
+        row = [bam_file, output_file, "error", "", "%.2f" % (time.time() - start), "%s: %s" % (type(e).__name__, e)]
+        return row, (os.path.basename(bam_file), [], np.zeros(0), np.zeros(0, dtype=np.int64)) if cohort else None
+    row = [bam_file, output_file, "ok", str(len(result["sites"])), "%.2f" % (time.time() - start), ""]
+    if not cohort:
+        return row, None
+    proportion = result["proportion"]
+    sites = [[i[0], i[1], i[4]] for i in result["sites"]]
+    return row, (os.path.basename(bam_file), sites, proportion[:, 0] + proportion[:, 2], result["counts"].sum(axis=1))
+
+
+def get_samples(manifest=None, bam_glob=None, output_dir="."):
+    # manifest is tab separated: bam file and (optionally) output svg, one sample per line
+    samples = []
+    if manifest is not None:
+        with open(manifest) as f:
+            for line in f:
+                splitline = line.rstrip().split("\t")
+                if splitline[0] == "" or splitline[0].startswith("#"):
+                    continue
+                if len(splitline) > 1 and splitline[1] != "":
+                    samples.append((splitline[0], splitline[1]))
+                else:
+                    samples.append((splitline[0], None))
+    if bam_glob is not None:
+        for bam_file in sorted(glob.glob(bam_glob)):
+            samples.append((bam_file, None))
+    for num, (bam_file, output_file) in enumerate(samples):
+        if output_file is None:
+            name = os.path.basename(bam_file)
+            if name.endswith(".bam"):
+                name = name[:-4]
+            samples[num] = (bam_file, os.path.join(output_dir, name + ".svg"))
+    return samples
+
+
+def batch_main(samples, variantA, variantB, summary_file, all_variants, all_minor, all_minor_fraction, all_minor_cov, panel3, jobs=1, threads=1,
+               cache_dir=None, cache_size=None, reference=None, contigs=None, variant_file=None, sample_depth=None, seed=0, cohort_file=None,
+               cohort_height=1000, link_distance=None, coverage_bin=None, results_dir=None, pileup=None):
+    # with cohort_file the samples are also drawn together as a heatmap, one row per sample in the order given
     dirname = os.path.dirname(__file__)
-    variant_file = os.path.join(dirname, 'data', "variants.tsv")
-    ref = os.path.join(os.path.dirname(__file__), 'data', "nCoV-2019.reference.fasta")
-    refseq = ""
-    with open(ref) as f:
-        for line in f:
-            if not line.startswith(">"):
-                refseq += line.rstrip()
+    if variant_file is None:
+        variant_file = os.path.join(dirname, 'data', "variants.tsv")
+    if reference is None:
+        reference = os.path.join(dirname, 'data', "nCoV-2019.reference.fasta")
+    # make the .fai before the workers start, each worker then opens its own handle on the indexed reference
+    open_reference(reference).close()
+    open_reference.cache_clear()
     sites = get_sites(variantA, variantB, variant_file, not all_variants)
-    alignment = pysam.AlignmentFile(bam_file, "rb")
-    if all_minor:
-        sites = get_minor(sites, alignment, refseq, all_minor_fraction, all_minor_cov)
-    proportion = []
-    depths = []
-    names = []
-    positions = []
-    bases = []
-    for i in sites:
-        aa, pos, varA, varB = i
-        basefreq = get_depth(pos-1, alignment)
-        varA_count, varB_count, both, other = 0, 0, 0, 0
-        total = 0
-        for i in basefreq:
-            if i == varA == varB:
-                both = basefreq[i]
-            elif i == varA:
-                varA_count = basefreq[i]
-            elif i == varB:
-                varB_count = basefreq[i]
+    # pool workers are daemonic and can't start their own genome scan pools
+    if jobs > 1:
+        threads = 1
+    worker = functools.partial(_batch_worker, cohort=cohort_file is not None, results_dir=results_dir, sites=sites, reference=reference, variantA=variantA, variantB=variantB,
+                               all_minor=all_minor, all_minor_fraction=all_minor_fraction, all_minor_cov=all_minor_cov,
+                               panel3=panel3, threads=threads, cache_dir=cache_dir, cache_size=cache_size, contigs=contigs,
+                               sample_depth=sample_depth, seed=seed, link_distance=link_distance, coverage_bin=coverage_bin, pileup=pileup)
+    if jobs > 1:
+        with multiprocessing.Pool(jobs) as pool:
+            results = pool.map(worker, samples, chunksize=1)
+    else:
+        results = [worker(i) for i in samples]
+    cohort = [i[1] for i in results if i[1] is not None]
+    results = [i[0] for i in results]
+    if cohort_file is not None:
+        draw_cohort(cohort, cohort_file, variantA, variantB, cohort_height)
+    with open(summary_file, "w") as out:
+        out.write("bam_file\toutput\tstatus\tsites\tseconds\terror\n")
+        for i in results:
+            out.write("\t".join(i) + "\n")
+    return results
+
+
+class Session:
+    # keeps the reference, the parsed variant table and open bam files between calls, for use as a library or by the server.
+    # bam files and site lists are evicted least recently used first, a bam file that changed on disk is reopened
+
+    def __init__(self, reference=None, variant_file=None, cache_dir=None, cache_size=None, max_bams=16, max_site_lists=64, pileup=None):
+        dirname = os.path.dirname(os.path.abspath(__file__))
+        if reference is None:
+            reference = os.path.join(dirname, 'data', "nCoV-2019.reference.fasta")
+        if variant_file is None:
+            variant_file = os.path.join(dirname, 'data', "variants.tsv")
+        self.reference = pysam.FastaFile(reference)
+        self.variant_file = variant_file
+        self.variants = open_variant_db(variant_file) if os.path.isdir(variant_file) else VariantTable(variant_file)
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.max_bams = max_bams
+        self.max_site_lists = max_site_lists
+        self.pileup = pileup
+        self.bams = collections.OrderedDict()
+        self.site_lists = collections.OrderedDict()
+
+    def alignment(self, bam_file):
+        stat = os.stat(bam_file)
+        key = (stat.st_size, stat.st_mtime_ns)
+        if bam_file in self.bams:
+            alignment, old_key = self.bams.pop(bam_file)
+            if old_key == key:
+                self.bams[bam_file] = (alignment, key)
+                return alignment
+            alignment.close()
+        alignment = pysam.AlignmentFile(bam_file, "rb")
+        self.bams[bam_file] = (alignment, key)
+        while len(self.bams) > self.max_bams:
+            self.bams.popitem(last=False)[1][0].close()
+        return alignment
+
+    def sites(self, variantA, variantB, all_variants=False):
+        key = (variantA, variantB, all_variants)
+        if key in self.site_lists:
+            self.site_lists.move_to_end(key)
+        else:
+            self.site_lists[key] = self.variants.get_sites(variantA, variantB, not all_variants)
+            while len(self.site_lists) > self.max_site_lists:
+                self.site_lists.popitem(last=False)
+        return self.site_lists[key]
+
+    def analyse(self, bam_file, variantA, variantB, all_variants=False, all_minor=False, minor_fraction=0.2, minor_depth=20, contigs=None,
+                threads=1, stats=None, sample_depth=None, seed=0):
+        # per site counts and proportions, see compute_sample
+        sites = self.sites(variantA, variantB, all_variants)
+        alignment = None if self.cache_dir is not None else self.alignment(bam_file)
+        return compute_sample(bam_file, sites, self.reference, all_minor, minor_fraction, minor_depth, threads, self.cache_dir,
+                              self.cache_size, stats, contigs, alignment, sample_depth=sample_depth, seed=seed, pileup=self.pileup)
+
+    def plot(self, bam_file, variantA, variantB, all_variants=False, all_minor=False, minor_fraction=0.2, minor_depth=20, panel3=False,
+             contigs=None, threads=1, sample_depth=None, seed=0):
+        # analyse and draw, returns the result and the svg as bytes
+        result = self.analyse(bam_file, variantA, variantB, all_variants, all_minor, minor_fraction, minor_depth, contigs, threads,
+                              sample_depth=sample_depth, seed=seed)
+        if not result["sites"]:
+            raise ValueError("no sites to draw for %s and %s" % (variantA, variantB))
+        return result, render_sample(result, self.reference, variantA, variantB, panel3).tostring().encode()
+
+    def close(self):
+        for alignment, key in self.bams.values():
+            alignment.close()
+        self.bams.clear()
+        self.reference.close()
+
+
+def result_json(result):
+    sites = []
+    for num, i in enumerate(result["sites"]):
+        sites.append({"name": i[0], "contig": i[4], "position": i[1], "variant_1": i[2], "variant_2": i[3],
+                      "depth": int(result["counts"][num].sum()),
+                      "counts": dict(zip(BASES, result["counts"][num].tolist())),
+                      "proportion": dict(zip(["variant_1", "variant_2", "both", "other"], result["proportion"][num].tolist())),
+                      "interval": dict(zip(["variant_1", "variant_2", "both", "other"], result["intervals"][num].tolist()))})
+        if "saturated" in result:
+            sites[-1]["saturated"] = bool(result["saturated"][num])
+        if result["sample_depth"] is not None and "sampled" in result:
+            sites[-1]["sampled"] = bool(result["sampled"][num])
+        if "ref_bases" in result:
+            sites[-1]["ref_base"] = result["ref_bases"][num]
+        if "lineages" in result:
+            sites[-1]["lineage_alleles"] = result["lineage_alleles"][num]
+    out = {"sample_depth": result["sample_depth"], "sites": sites, "contigs": [{"name": i, "length": j} for i, j in result["contig_lengths"]]}
+    if "lineages" in result:
+        out["lineages"] = [{"name": i, "proportion": float(j)} for i, j in zip(result["lineages"], result["mixture"])]
+        out["explained"] = result["explained"]
+    if "linkage" in result:
+        # sites are indices into the site list
+        out["linkage"] = [{"site_1": i, "site_2": j, "r2": float(r2), "d": float(d)} for i, j, r2, d in result["linkage"]]
+    if result.get("coverage") is not None:
+        out["coverage"] = {"bin_size": result["coverage_bin"],
+                           "contigs": {contig: dict(zip(["min", "mean", "max"], stat.tolist())) for contig, stat in result["coverage"].items()}}
+    return out
+
+
+class CovbamicHandler(http.server.BaseHTTPRequestHandler):
+    # GET /plot returns the svg, GET /sites the counts as json. Parameters: bam, variant_1, variant_2 and optionally
+    # all, minor, fraction, depth, panel3 (flags are 0 or 1), contig (repeated for several contigs), sample_depth and seed
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path not in ("/plot", "/sites"):
+            self.send_error(404)
+            return
+        try:
+            args = dict(bam_file=query["bam"][0], variantA=query["variant_1"][0], variantB=query["variant_2"][0],
+                        all_variants=query.get("all", ["0"])[0] == "1", all_minor=query.get("minor", ["0"])[0] == "1",
+                        minor_fraction=float(query.get("fraction", [0.2])[0]), minor_depth=int(query.get("depth", [20])[0]),
+                        contigs=query.get("contig"), seed=int(query.get("seed", [0])[0]),
+                        sample_depth=int(query["sample_depth"][0]) if "sample_depth" in query else None)
+            if url.path == "/plot":
+                body = self.server.session.plot(panel3=query.get("panel3", ["0"])[0] == "1", **args)[1]
+                content_type = "image/svg+xml"
             else:
-                other += basefreq[i]
-            total += basefreq[i]
-        proportion.append([varA_count/total, varB_count/total, both/total, other/total])
-        depths.append(total)
-        names.append(aa)
-        positions.append(pos)
-        bases.append([basefreq["A"]/total, basefreq["T"]/total, basefreq["C"]/total, basefreq["G"]/total, basefreq["-"]/total])
-    draw_output(positions, proportion, depths, names, bases, output_file, variantA, variantB, refseq, panel3)
-
-
-
-parser = argparse.ArgumentParser()
-parser.add_argument("-o", "--output", help="output svg file", required=True)
-parser.add_argument("-b", "--bam_file", help="sorted and indexed bam file", required=True)
-parser.add_argument("-1", "--variant_1", help="variant 1 (BA.2, BA.4 or BA.5)", required=True)
-parser.add_argument("-2", "--variant_2", help="variant 2 (BA.2, BA.4 or BA.5)", required=True)
-parser.add_argument("-a", "--all", action="store_true", help="List all sites different from reference "
-                                                             "(as opposed to only sites that differ between the two variants selected).")
-parser.add_argument("-m", "--all_minor", action="store_true", help="List all sites where the minor allele reaches defined threshold.")
-parser.add_argument("-f", "--minor_fraction", type=float, default=0.2, help="Fraction of reads with minor allele to report (when -m set)")
-parser.add_argument("-d", "--minor_depth", type=int, default=20, help="minimum depth to report minor allele site (when -m set)")
-parser.add_argument("-p3", "--panel3", action="store_true", help="Draw panel 3.")
-
-args = parser.parse_args()
-
-__main__(args.bam_file, args.variant_1, args.variant_2, args.output, args.all, args.all_minor, args.minor_fraction, args.minor_depth, args.panel3)
\ No newline at end of file
+                body = json.dumps(result_json(self.server.session.analyse(**args))).encode()
+                content_type = "application/json"
+        except KeyError as e:
+            self.send_error(400, "missing parameter %s" % e)
+            return
+        except (ValueError, OSError) as e:
+            self.send_error(400, str(e))
+            return
+        except Exception as e:
+            self.log_error("error handling %s", self.path)
+            traceback.print_exc()
+            self.send_error(500, "%s: %s" % (type(e).__name__, e))
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix socket clients have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "unix"
+
+
+class UnixHTTPServer(socketserver.UnixStreamServer):
+
+    def get_request(self):
+        request, client_address = super().get_request()
+        return request, ("unix", 0)
+
+
+def serve(session, address):
+    # address is host:port or the path of a unix socket. Requests are handled one at a time as pysam handles
+    # can't be shared between threads. A socket left at the path by an earlier server is replaced, anything else
+    # there is an error, and the socket is removed on shutdown
+    socket_path = None
+    if ":" in address and not os.path.sep in address:
+        host, port = address.rsplit(":", 1)
+        server = http.server.HTTPServer((host, int(port)), CovbamicHandler)
+    else:
+        if os.path.lexists(address):
+            if not stat.S_ISSOCK(os.lstat(address).st_mode):
+                raise ValueError("%s exists and is not a socket, give a new path or HOST:PORT to serve on" % address)
+            os.remove(address)
+        server = UnixHTTPServer(address, CovbamicHandler)
+        socket_path = address
+    server.session = session
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        session.close()
+        if socket_path is not None and os.path.lexists(socket_path):
+            os.remove(socket_path)
+
+
+def __main__(bam_file, variantA, variantB, output_file, all_variants, all_minor, all_minor_fraction, all_minor_cov, panel3, threads=1,
+             cache_dir=None, cache_size=None, stats_json=None, profile=None, reference=None, contigs=None, variant_file=None, stream=False,
+             sample_depth=None, seed=0, lineages=None, link_distance=None, coverage_bin=None, results_file=None, pileup=None):
+    # with lineages, variantA and variantB are ignored and every lineage's proportion is estimated in one pass
+    stats = RunStats(profile is not None, stats_json is not None)
+    dirname = os.path.dirname(__file__)
+    if variant_file is None:
+        variant_file = os.path.join(dirname, 'data', "variants.tsv")
+    if reference is None:
+        reference = os.path.join(dirname, 'data', "nCoV-2019.reference.fasta")
+    with stats.stage("load_reference"):
+        reference = open_reference(reference)
+    lineage_alleles = None
+    with stats.stage("get_sites"):
+        if lineages is None:
+            sites = get_sites(variantA, variantB, variant_file, not all_variants)
+        else:
+            sites, alleles = get_lineage_sites(lineages, variant_file, not all_variants)
+            lineage_alleles = {i[1]: j for i, j in zip(sites, alleles)}
+            variantA, variantB = lineages[0], lineages[-1]
+    result = run_sample(bam_file, output_file, sites, reference, variantA, variantB, all_minor, all_minor_fraction, all_minor_cov, panel3,
+                        threads, cache_dir, cache_size, stats, contigs, stream, sample_depth, seed, lineages, lineage_alleles, link_distance,
+                        coverage_bin, results_file, pileup)
+    if result["saturated"].any():
+        max_depth = (pileup or DEFAULT_PILEUP)["max_depth"]
+        sys.stderr.write("%d sites lost reads to the pileup depth limit of %d reads (--max_depth 0 counts every read)\n" % (
+            result["saturated"].sum(), max_depth))
+    if lineages is not None:
+        for lineage, proportion in zip(lineages, result["mixture"]):
+            sys.stderr.write("%s\t%.4f\n" % (lineage, proportion))
+        sys.stderr.write("explained\t%.4f\n" % result["explained"])
+    if stats_json is not None:
+        stats.write_json(stats_json, bam_file=bam_file, output=output_file, variant_1=variantA, variant_2=variantB, threads=threads,
+                         sample_depth=sample_depth, seed=seed, lineages=lineages, pileup=pileup or DEFAULT_PILEUP)
+    if profile is not None:
+        stats.write_profile(profile)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", help="output svg file")
+    parser.add_argument("-b", "--bam_file", help="sorted and indexed bam file (with --stream any sam/bam file, default: stdin)")
+    parser.add_argument("-1", "--variant_1", help="variant 1 (BA.2, BA.4 or BA.5, or any lineage in -V)")
+    parser.add_argument("-2", "--variant_2", help="variant 2 (BA.2, BA.4 or BA.5, or any lineage in -V)")
+    parser.add_argument("-L", "--lineages", nargs="+", help="estimate the proportion of each of these lineages in the sample (in place of -1 and -2)")
+    parser.add_argument("-a", "--all", action="store_true", help="List all sites different from reference "
+                                                                 "(as opposed to only sites that differ between the two variants selected).")
+    parser.add_argument("-m", "--all_minor", action="store_true", help="List all sites where the minor allele reaches defined threshold.")
+    parser.add_argument("-f", "--minor_fraction", type=float, default=0.2, help="Fraction of reads with minor allele to report (when -m set)")
+    parser.add_argument("-d", "--minor_depth", type=int, default=20, help="minimum depth to report minor allele site (when -m set)")
+    parser.add_argument("-p3", "--panel3", action="store_true", help="Draw panel 3.")
+    parser.add_argument("-t", "--threads", type=int, default=1, help="Number of processes used to scan the genome (when -m set)")
+    parser.add_argument("-V", "--variants", help="variant table or database compiled with --compile_variants (default: bundled data/variants.tsv)")
+    parser.add_argument("--compile_variants", metavar="DB", help="compile the variant table (-V) into database directory DB and exit")
+    parser.add_argument("-r", "--reference", help="reference fasta, indexed with samtools faidx if there is no .fai (default: bundled MN908947.3)")
+    parser.add_argument("-C", "--contig", nargs="+", help="contig(s) to look at (default: every contig in both the bam header and the reference, "
+                                                          "variant table sites are placed on the SARS-CoV-2 one, else the first)")
+    parser.add_argument("--stream", action="store_true", help="count the reads in one pass in file order, the bam file doesn't need to be sorted "
+                                                              "or indexed and can be piped in (not cached)")
+    parser.add_argument("--sample_depth", type=int, help="count columns of the genome wide scan (-m or -c) deeper than this from a seeded "
+                                                         "sample of about this many reads, the depth panel still shows the full depth and the "
+                                                         "proportions get confidence intervals (not with --stream)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the read sample (with --sample_depth)")
+    parser.add_argument("--linkage", type=int, nargs="?", const=500, metavar="DISTANCE",
+                        help="draw a panel of how often the alleles of sites up to DISTANCE (default 500) apart are on the same read pair (not with --stream)")
+    parser.add_argument("--coverage", type=int, nargs="?", const=100, metavar="BIN_SIZE",
+                        help="draw the min, mean and max depth of every BIN_SIZE (default 100) columns along the genome")
+    parser.add_argument("--results", help="write the counts and proportions of each site to this file, as json if it ends in .json "
+                                           "(which --render can draw from) otherwise tsv. The svg is left out without -o (batch mode: a directory "
+                                           "for a .json file per sample)")
+    parser.add_argument("--render", nargs="+", metavar="RESULTS", help="draw the svg (-o, or OUTPUT_DIR/<name>.svg for several) from .json "
+                                                                       "results files without reading the bam files")
+    parser.add_argument("-q", "--min_base_quality", type=int, default=13, help="minimum base quality counted (at least 1)")
+    parser.add_argument("-Q", "--min_mapping_quality", type=int, default=0, help="minimum mapping quality of the reads counted")
+    parser.add_argument("--max_depth", type=int, default=8000, help="reads the pileup looks at per column, 0 for every read. Sites "
+                                                                    "that lost reads to the limit are reported as saturated")
+    parser.add_argument("-c", "--cache_dir", help="directory to cache per bam allele counts in, re-runs on the same bam file skip the pileup")
+    parser.add_argument("-S", "--cache_size", type=float, default=1000, help="maximum size of the cache directory in MB, least recently used bam files are evicted first")
+    parser.add_argument("--stats_json", help="write wall time, peak memory and work counters for each stage to this json file")
+    parser.add_argument("--profile", help="write a cProfile dump of the counting stages to this file (read with pstats)")
+    parser.add_argument("--serve", metavar="ADDRESS", help="run as a server on HOST:PORT or a unix socket path, keeping the reference, variant table "
+                                                           "and bam files open between requests")
+    parser.add_argument("--max_bams", type=int, default=16, help="bam files kept open by the server")
+    parser.add_argument("-M", "--manifest", help="batch mode: tab separated file of sorted and indexed bam files and (optional) output svg files")
+    parser.add_argument("-g", "--bam_glob", help="batch mode: glob of sorted and indexed bam files")
+    parser.add_argument("-O", "--output_dir", default=".", help="directory for svg files not named in the manifest (batch mode)")
+    parser.add_argument("-s", "--summary", default="covbamic_summary.tsv", help="summary tsv file (batch mode)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of samples processed in parallel (batch mode)")
+    parser.add_argument("--cohort", help="also draw every sample as a row of one heatmap svg (batch mode)")
+    parser.add_argument("--cohort_height", type=int, default=1000, help="height of the heatmap in pixels, samples are binned beyond one per pixel (with --cohort)")
+
+    args = parser.parse_args()
+    if args.min_base_quality < 1:
+        parser.error("-q/--min_base_quality must be at least 1, overlapping mates would be counted twice below that")
+    cache_size = int(args.cache_size * 1024 * 1024)
+    pileup = pileup_args(args.min_base_quality, args.min_mapping_quality, args.max_depth)
+
+    if args.compile_variants is not None:
+        variant_file = args.variants
+        if variant_file is None:
+            variant_file = os.path.join(os.path.dirname(__file__), 'data', "variants.tsv")
+        num_lineages, num_sites = compile_variants(variant_file, args.compile_variants)
+        sys.stderr.write("compiled %d lineages and %d sites into %s\n" % (num_lineages, num_sites, args.compile_variants))
+    elif args.serve is not None:
+        try:
+            serve(Session(args.reference, args.variants, args.cache_dir, cache_size, args.max_bams, pileup=pileup), args.serve)
+        except ValueError as e:
+            parser.error(str(e))
+    elif args.render is not None:
+        if len(args.render) == 1 and args.output is not None:
+            render_results(args.render[0], args.output, args.panel3)
+        else:
+            os.makedirs(args.output_dir, exist_ok=True)
+            for results_file in args.render:
+                output_file = os.path.join(args.output_dir, os.path.splitext(os.path.basename(results_file))[0] + ".svg")
+                render_results(results_file, output_file, args.panel3)
+    elif args.lineages is None and (args.variant_1 is None or args.variant_2 is None):
+        parser.error("-1/--variant_1 and -2/--variant_2 (or -L/--lineages) are required")
+    elif args.lineages is not None and (args.manifest is not None or args.bam_glob is not None):
+        parser.error("-L/--lineages is not supported in batch mode")
+    elif args.stream and (args.manifest is not None or args.bam_glob is not None):
+        parser.error("--stream is not supported in batch mode, the bam files are read through their index")
+    elif (args.stats_json is not None or args.profile is not None) and (args.manifest is not None or args.bam_glob is not None):
+        parser.error("--stats_json and --profile are not supported in batch mode")
+    elif min(args.min_mapping_quality, args.max_depth) < 0:
+        parser.error("-Q/--min_mapping_quality and --max_depth can't be negative")
+    elif args.sample_depth is not None and args.sample_depth < 1:
+        parser.error("--sample_depth must be at least 1")
+    elif args.coverage is not None and args.coverage < 1:
+        parser.error("--coverage BIN_SIZE must be at least 1")
+    elif args.cohort_height < 1:
+        parser.error("--cohort_height must be at least 1")
+    elif args.linkage is not None and args.stream:
+        parser.error("--linkage needs a sorted and indexed bam file, not --stream")
+    elif args.manifest is not None or args.bam_glob is not None:
+        samples = get_samples(args.manifest, args.bam_glob, args.output_dir)
+        os.makedirs(args.output_dir, exist_ok=True)
+        if args.results is not None:
+            os.makedirs(args.results, exist_ok=True)
+        results = batch_main(samples, args.variant_1, args.variant_2, args.summary, args.all, args.all_minor, args.minor_fraction,
+                             args.minor_depth, args.panel3, args.jobs, args.threads, args.cache_dir, cache_size, args.reference, args.contig,
+                             args.variants, args.sample_depth, args.seed, args.cohort, args.cohort_height, args.linkage,
+                             args.coverage, args.results, pileup)
+        failed = [i for i in results if i[2] != "ok"]
+        for i in failed:
+            sys.stderr.write("%s failed: %s\n" % (i[0], i[5]))
+        if failed:
+            sys.exit(1)
+    elif (args.output is None and args.results is None) or (args.bam_file is None and not args.stream):
+        parser.error("-b/--bam_file and -o/--output (or --results) are required unless -M/--manifest or -g/--bam_glob is given")
+    else:
+        bam_file = "-" if args.bam_file is None else args.bam_file
+        __main__(bam_file, args.variant_1, args.variant_2, args.output, args.all, args.all_minor, args.minor_fraction, args.minor_depth, args.panel3, args.threads,
+                 args.cache_dir, cache_size, args.stats_json, args.profile, args.reference, args.contig, args.variants, args.stream,
+                 args.sample_depth, args.seed, args.lineages, args.linkage, args.coverage, args.results, pileup)
\ No newline at end of file